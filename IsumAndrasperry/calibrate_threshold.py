@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Threshold calibration, the Python replacement of matlabCode/umbral.m.
+
+Reads the healthy (Class A) and damaged (Class B) capture archives, extracts
+the classifier spectra in a process pool and computes, for every capture,
+diff = mean correlation with Class A - mean correlation with Class B
+(excluding the capture itself), exactly as umbral.m. The correlation matrix
+is computed in row blocks so only block_size x N values are in memory.
+
+It also calibrates the statistical anomaly rules of shmAnomali.detect_anomalies:
+for each metric, the factor of its change scale (old standard deviation, old
+variance for Variance) that consecutive healthy captures stay below, and the
+|z| that healthy captures stay below against the rolling baseline of the
+previous ones.
+
+    python3 calibrate_threshold.py --healthy ./nodamage --damaged ./damage -o thresholds.json
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+import shmAnomali
+from rolling_baseline import RollingBaseline
+
+def list_captures(folder):
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith('.bin')]
+
+def extract_features(path):
+    """Classifier spectrum and channel statistics of one capture (runs in a worker)."""
+    data = shmAnomali.read_and_reshape(path)
+    spectrum = shmAnomali.normalized_spectrum(shmAnomali.classifier_signal(data))
+    # Statistics of the preprocessed signal, exactly as the server computes them
+    return spectrum, shmAnomali.analysis_features(data)['stats']
+
+def extract_all(paths, workers, chunksize=16):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        features = list(pool.map(extract_features, paths, chunksize=chunksize))
+    spectra = np.stack([spectrum for spectrum, _ in features])
+    stats = np.stack([stats for _, stats in features])
+    return spectra, stats
+
+def correlation_diffs(spectra, is_a, block_size=256):
+    """
+    diff of every capture: mean correlation with the other Class A captures minus
+    mean correlation with the other Class B captures, in blocks of rows.
+    """
+    n_a = int(is_a.sum())
+    n_b = len(is_a) - n_a
+    diffs = np.empty(len(spectra))
+    for start in range(0, len(spectra), block_size):
+        block = spectra[start:start + block_size] @ spectra.T  # (block, N) correlations
+        rows = np.arange(start, start + len(block))
+        block[rows - start, rows] = 0.0  # Exclude the capture itself
+        sum_a = block[:, is_a].sum(axis=1, dtype=np.float64)
+        sum_b = block[:, ~is_a].sum(axis=1, dtype=np.float64)
+        own_a = is_a[rows]
+        mean_a = sum_a / np.where(own_a, n_a - 1, n_a)
+        mean_b = sum_b / np.where(own_a, n_b, n_b - 1)
+        diffs[rows] = mean_a - mean_b
+    return diffs
+
+def best_threshold(diffs, is_a):
+    """umbral.m method 2: the candidate with the fewest errors when diff > t means Class A."""
+    candidates = np.unique(diffs)
+    sorted_a = np.sort(diffs[is_a])
+    sorted_b = np.sort(diffs[~is_a])
+    errors = (np.searchsorted(sorted_a, candidates, side='right') +
+              len(sorted_b) - np.searchsorted(sorted_b, candidates, side='right'))
+    best = int(np.argmin(errors))  # First minimum, as the MATLAB loop
+    return float(candidates[best]), int(errors[best])
+
+def std_factors(stats, percentile):
+    """Per metric, the given percentile of |new - old| / change scale over consecutive healthy captures."""
+    old, new = stats[:-1], stats[1:]
+    factors = {}
+    for metric in shmAnomali.STAT_METRICS:
+        scale = shmAnomali.change_scale(old, metric)
+        scale = np.where(scale > 0, scale, np.nan)
+        factors[metric] = float(np.nanpercentile(np.abs(new[metric] - old[metric]) / scale, percentile))
+    return factors
+
+def baseline_z_limits(stats, percentile, window=shmAnomali.BASELINE_WINDOW):
+    """Per metric, the given percentile of |z| of healthy captures against the rolling baseline of the previous ones."""
+    features = structured_to_unstructured(stats)  # (captures, channels, metrics)
+    baseline = RollingBaseline(features.shape[1:], window)
+    zscores = []
+    for capture in features:
+        if baseline.ready:
+            zscores.append(np.abs(baseline.zscores(capture)))
+        baseline.update(capture)
+    if not zscores:
+        return {}  # Too few captures to warm up the baseline: shmAnomali keeps BASELINE_Z_LIMIT
+    zscores = np.stack(zscores)
+    return {metric: float(np.percentile(zscores[..., m], percentile))
+            for m, metric in enumerate(shmAnomali.STAT_METRICS)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--healthy', default=shmAnomali.REFERENCE_FOLDER_A, help='Class A capture folder')
+    parser.add_argument('--damaged', default=shmAnomali.REFERENCE_FOLDER_B, help='Class B capture folder')
+    parser.add_argument('-o', '--output', default=shmAnomali.THRESHOLD_FILE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--block-size', type=int, default=256, help='Rows of the correlation matrix per block')
+    parser.add_argument('--percentile', type=float, default=99.5,
+                        help='Percentile of healthy changes used as the std factor and |z| limit of each metric')
+    args = parser.parse_args()
+
+    paths_a = list_captures(args.healthy)
+    paths_b = list_captures(args.damaged)
+    if len(paths_a) < 2 or len(paths_b) < 2:
+        raise SystemExit('Se necesitan al menos dos capturas por clase')
+
+    started = time.time()
+    spectra, stats = extract_all(paths_a + paths_b, args.workers)
+    is_a = np.zeros(len(spectra), dtype=bool)
+    is_a[:len(paths_a)] = True
+    print(f'Espectros de {len(spectra)} capturas extraidos en {time.time() - started:.1f} s')
+
+    diffs = correlation_diffs(spectra, is_a, args.block_size)
+    threshold_avg = float((diffs[is_a].mean() + diffs[~is_a].mean()) / 2)
+    threshold, errors = best_threshold(diffs, is_a)
+    factors = std_factors(stats[:len(paths_a)], args.percentile)
+    z_limits = baseline_z_limits(stats[:len(paths_a)], args.percentile)
+
+    print(f'Umbral (metodo promedio): {threshold_avg:.4f}')
+    print(f'Umbral (minimizacion de error): {threshold:.4f}, con {errors} errores de {len(diffs)} muestras')
+    for metric, factor in factors.items():
+        print(f'Factor de desviacion para {metric}: {factor:.3f}')
+    for metric, limit in z_limits.items():
+        print(f'Limite |z| frente a la linea base para {metric}: {limit:.3f}')
+
+    thresholds = {
+        'correlation_threshold': threshold,
+        'correlation_threshold_avg': threshold_avg,
+        'training_errors': errors,
+        'samples_a': len(paths_a),
+        'samples_b': len(paths_b),
+        'channel': shmAnomali.CLASSIFIER_CHANNEL,
+        'std_factor': factors,
+        'baseline_z_limit': z_limits,
+        'percentile': args.percentile,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(thresholds, f, indent=2)
+    print(f'Umbrales guardados en {args.output} ({time.time() - started:.1f} s)')
+
+if __name__ == '__main__':
+    main()
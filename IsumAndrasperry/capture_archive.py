@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compressed archive of the raw ISUM captures.
+
+Analyzed captures are appended to segment files instead of being deleted:
+
+- every channel is cut in blocks of block_samples samples; a block is delta
+  encoded (int16, wrapping), byte shuffled (low bytes, then high bytes) and
+  compressed on its own with zlib or lzma, so it can be decoded without the
+  rest of the capture;
+- a capture record is a header (timestamp, shape, block size, codec) and the
+  compressed length of every block, followed by the blocks, channel by
+  channel;
+- every segment <first timestamp>.seg has a sidecar <first timestamp>.idx of
+  fixed (timestamp, offset, length) records: a reader finds a capture with a
+  binary search and seeks straight to the blocks it needs;
+- a new segment is started at segment_bytes, and the oldest segments are
+  deleted when the archive grows over its size budget.
+
+The segment is synced before its index record is written, so a crash leaves
+at most an unindexed tail, which the next append overwrites. Only the writer
+modifies the files; readers can open the archive at any time.
+
+    python3 capture_archive.py ./archive list --since 2024-06-01
+    python3 capture_archive.py ./archive extract ./captures --since 2024-06-01 --until 2024-06-02
+    python3 capture_archive.py ./archive channel 3 channel3.npy --since 2024-06-01T10:00:00
+"""
+
+import argparse
+import bisect
+import lzma
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+BLOCK_SAMPLES = 4096  # Samples per compressed block (4 s at 1 kHz)
+CODECS = ('zlib', 'lzma')
+
+CAPTURE_MAGIC = b'ISCA'
+CAPTURE_HEADER = struct.Struct('<4sqHIIB')  # magic, timestamp (ns), channels, samples, block samples, codec
+INDEX_RECORD = struct.Struct('<qQI')  # timestamp (ns), offset in the segment, record length
+
+def encode_block(samples, codec='zlib', level=6):
+    """Delta encoded, byte shuffled and compressed bytes of a 1-D int16 block."""
+    deltas = np.diff(np.asarray(samples, dtype=np.int16), prepend=np.int16(0)).astype('<i2', copy=False)
+    shuffled = deltas.view(np.uint8).reshape(-1, 2).T.tobytes()
+    if codec == 'lzma':
+        return lzma.compress(shuffled, preset=level)
+    return zlib.compress(shuffled, level)
+
+def decode_block(data, codec='zlib'):
+    """Inverse of encode_block."""
+    shuffled = lzma.decompress(data) if codec == 'lzma' else zlib.decompress(data)
+    deltas = np.frombuffer(shuffled, dtype=np.uint8).reshape(2, -1).T.copy().view('<i2').ravel()
+    return np.cumsum(deltas, dtype=np.int16)
+
+class _Segment:
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name + '.seg')
+        self.index_path = os.path.join(directory, name + '.idx')
+        self.timestamps = []  # Sorted
+        self.offsets = []
+        self.lengths = []
+        self.end = 0  # End of the last indexed record
+
+    def load(self):
+        """Read the sidecar index, ignoring a partial last record."""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        for record in sorted(INDEX_RECORD.iter_unpack(data[:usable])):
+            self.add(*record)
+
+    def add(self, timestamp, offset, length):
+        position = bisect.bisect(self.timestamps, timestamp)
+        self.timestamps.insert(position, timestamp)
+        self.offsets.insert(position, offset)
+        self.lengths.insert(position, length)
+        self.end = max(self.end, offset + length)
+
+    def find(self, timestamp):
+        position = bisect.bisect_left(self.timestamps, timestamp)
+        if position < len(self.timestamps) and self.timestamps[position] == timestamp:
+            return self.offsets[position], self.lengths[position]
+        return None
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in (self.path, self.index_path) if os.path.exists(path))
+
+class CaptureArchive:
+
+    def __init__(self, directory='./archive', budget_bytes=2 * 1024 ** 3, segment_bytes=SEGMENT_BYTES,
+                 block_samples=BLOCK_SAMPLES, codec='zlib', level=6):
+        """
+        budget_bytes: size of all segments and indexes; the oldest segments are evicted above it
+        segment_bytes: size at which a new segment is started
+        codec, level: 'zlib' (levels 1-9) or 'lzma' (presets 0-9), for new captures
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.segment_bytes = segment_bytes
+        self.block_samples = block_samples
+        self.codec = codec
+        self.level = level
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []  # Oldest first
+        for name in sorted({os.path.splitext(entry)[0] for entry in os.listdir(directory)
+                            if entry.endswith(('.seg', '.idx'))}):
+            segment = _Segment(directory, name)
+            segment.load()
+            self.segments.append(segment)
+        self.size = sum(segment.size() for segment in self.segments)
+
+    def __len__(self):
+        return sum(len(segment.timestamps) for segment in self.segments)
+
+    def _find(self, timestamp):
+        for segment in self.segments:
+            location = segment.find(timestamp)
+            if location is not None:
+                return segment, location
+        return None
+
+    def encode(self, data, timestamp):
+        """Capture record of a (channels, samples) int16 array."""
+        channels, samples = data.shape
+        blocks = [encode_block(data[channel, start:start + self.block_samples], self.codec, self.level)
+                  for channel in range(channels) for start in range(0, samples, self.block_samples)]
+        header = CAPTURE_HEADER.pack(CAPTURE_MAGIC, timestamp, channels, samples, self.block_samples,
+                                     CODECS.index(self.codec))
+        lengths = np.array([len(block) for block in blocks], dtype='<u4').tobytes()
+        return b''.join([header, lengths] + blocks)
+
+    def _free_timestamp(self, data, timestamp):
+        """`timestamp`, or the next free one if a different capture is archived there; None if this one is."""
+        while True:
+            with self._lock:
+                if self._find(timestamp) is None:
+                    return timestamp
+            try:
+                if np.array_equal(self.read(timestamp), data):
+                    return None
+            except KeyError:
+                continue  # Evicted in the meantime
+            except (OSError, ValueError, zlib.error, lzma.LZMAError):
+                pass  # Unreadable record: keep it and store this capture next to it
+            timestamp += 1
+
+    def append(self, data, timestamp):
+        """Archive a (channels, samples) int16 capture taken at `timestamp` (ns since the epoch).
+
+        Returns False if this same capture is already archived. A different
+        capture with the same timestamp (e.g. two files with the same mtime) is
+        archived at the next free nanosecond.
+        """
+        data = np.asarray(data)
+        if data.ndim != 2 or data.dtype != np.int16:
+            raise ValueError(f"Expected a (channels, samples) int16 capture, got {data.dtype} {data.shape}")
+        while True:
+            timestamp = self._free_timestamp(data, timestamp)
+            if timestamp is None:
+                return False
+            record = self.encode(data, timestamp)  # Outside the lock: this is the slow part
+            with self._lock:
+                if self._find(timestamp) is None:
+                    self._write(record, timestamp)
+                    return True
+            # Taken while encoding: look for a free timestamp again
+
+    def _write(self, record, timestamp):
+        """Append an encoded record to the last segment (caller holds the lock)."""
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or (segment.timestamps and segment.end + len(record) > self.segment_bytes):
+            # Names keep the segments in write order even if an older capture is archived late
+            first = timestamp if segment is None else max(timestamp, segment.timestamps[-1] + 1)
+            segment = _Segment(self.directory, f'{first:020d}')
+            self.segments.append(segment)
+        before = segment.size()
+
+        with open(segment.path, 'ab') as f:
+            f.truncate(segment.end)  # Unindexed tail of an interrupted append
+            f.seek(segment.end)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(segment.index_path, 'ab') as f:
+            f.truncate(len(segment.timestamps) * INDEX_RECORD.size)
+            f.seek(0, os.SEEK_END)
+            f.write(INDEX_RECORD.pack(timestamp, segment.end, len(record)))
+        segment.add(timestamp, segment.end, len(record))
+        self.size += segment.size() - before
+        self._evict()
+
+    def append_file(self, path, shape):
+        """Archive a capture file with its modification time as timestamp."""
+        timestamp = os.stat(path).st_mtime_ns
+        data = np.fromfile(path, dtype=np.int16)
+        if data.size != shape[0] * shape[1]:
+            raise ValueError(f"{path} has {data.size} samples, expected {shape[0]} x {shape[1]}")
+        return self.append(data.reshape(shape), timestamp)
+
+    def _evict(self):
+        """Delete the oldest segments while over the budget (caller holds the lock)."""
+        while self.size > self.budget_bytes and len(self.segments) > 1:
+            segment = self.segments.pop(0)
+            self.size -= segment.size()
+            for path in (segment.index_path, segment.path):  # Index first: a segment without one holds no captures
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            print(f"Archivo: segmento {segment.name} eliminado ({len(segment.timestamps)} capturas)")
+
+    def timestamps(self, since=None, until=None):
+        """Timestamps (ns) of the archived captures in [since, until), oldest first."""
+        found = []
+        with self._lock:
+            for segment in self.segments:
+                low = 0 if since is None else bisect.bisect_left(segment.timestamps, since)
+                high = len(segment.timestamps) if until is None else bisect.bisect_left(segment.timestamps, until)
+                found.extend(segment.timestamps[low:high])
+        found.sort()
+        return found
+
+    def read(self, timestamp, channel=None, start=0, stop=None):
+        """
+        The capture archived at `timestamp`: the whole (channels, samples)
+        array, or samples [start, stop) of one channel. Only the blocks that
+        are needed are read and decompressed.
+        """
+        with self._lock:
+            found = self._find(timestamp)
+        if found is None:
+            raise KeyError(f"No archived capture at {timestamp}")
+        segment, (offset, length) = found
+        with open(segment.path, 'rb') as f:
+            f.seek(offset)
+            magic, _, channels, samples, block_samples, codec = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))
+            if magic != CAPTURE_MAGIC:
+                raise ValueError(f"Corrupt capture record at {segment.path}:{offset}")
+            per_channel = -(-samples // block_samples)
+            lengths = np.frombuffer(f.read(4 * channels * per_channel), dtype='<u4').astype(np.int64)
+            data_offset = offset + CAPTURE_HEADER.size + 4 * len(lengths)
+            ends = np.cumsum(lengths)
+            codec = CODECS[codec]
+
+            if channel is None:
+                f.seek(data_offset)
+                payload = f.read(int(ends[-1]))
+                starts = ends - lengths
+                blocks = [decode_block(payload[a:b], codec) for a, b in zip(starts, ends)]
+                return np.concatenate(blocks).reshape(channels, samples)
+
+            if not 0 <= channel < channels:
+                raise ValueError(f"Channel {channel} out of range (0-{channels - 1})")
+            stop = samples if stop is None else min(stop, samples)
+            start = max(0, start)
+            if start >= stop:
+                return np.zeros(0, dtype=np.int16)
+            first = channel * per_channel + start // block_samples
+            last = channel * per_channel + (stop - 1) // block_samples
+            begin = int(ends[first] - lengths[first])
+            f.seek(data_offset + begin)
+            payload = f.read(int(ends[last]) - begin)
+        blocks = [decode_block(payload[int(ends[idx] - lengths[idx]) - begin:int(ends[idx]) - begin], codec)
+                  for idx in range(first, last + 1)]
+        skip = start - (start // block_samples) * block_samples
+        return np.concatenate(blocks)[skip:skip + stop - start]
+
+    def read_range(self, channel, since=None, until=None, start=0, stop=None):
+        """Yield (timestamp, samples) of one channel for every capture in [since, until)."""
+        for timestamp in self.timestamps(since, until):
+            yield timestamp, self.read(timestamp, channel, start, stop)
+
+def parse_date(value):
+    """YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS (UTC) -> nanoseconds since the epoch."""
+    moment = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1e9)
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp / 1e9, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archive', help='Archive directory')
+    parser.add_argument('--since', type=parse_date, help='First capture date (UTC)')
+    parser.add_argument('--until', type=parse_date, help='End date (UTC), exclusive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='Archived captures and their timestamps')
+    extract = commands.add_parser('extract', help='Write the captures back as .bin files (mtime = capture time)')
+    extract.add_argument('output', help='Output folder')
+    channel = commands.add_parser('channel', help='One channel of every capture in the range to a .npy file')
+    channel.add_argument('channel', type=int, help='Channel number, from 1')
+    channel.add_argument('output', help='.npy file, (captures, samples) int16')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.archive):
+        parser.error(f"{args.archive} is not a directory")
+    archive = CaptureArchive(args.archive)
+    timestamps = archive.timestamps(args.since, args.until)
+    if args.command == 'list':
+        for timestamp in timestamps:
+            print(f'{timestamp}  {format_timestamp(timestamp)}')
+        print(f'{len(timestamps)} capturas, {archive.size / 1e6:.1f} MB en {len(archive.segments)} segmentos')
+    elif args.command == 'extract':
+        os.makedirs(args.output, exist_ok=True)
+        for timestamp in timestamps:
+            path = os.path.join(args.output, f'capture_{timestamp}.bin')
+            archive.read(timestamp).tofile(path)
+            os.utime(path, ns=(timestamp, timestamp))
+        print(f'{len(timestamps)} capturas escritas en {args.output}')
+    else:
+        rows = [samples for _, samples in archive.read_range(args.channel - 1, args.since, args.until)]
+        np.save(args.output, np.array(rows, dtype=np.int16))
+        print(f'Canal {args.channel} de {len(rows)} capturas escrito en {args.output}')
+
+if __name__ == '__main__':
+    main()
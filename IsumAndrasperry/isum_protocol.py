@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary framing used between the ISUM analysis server and its clients.
+
+Every message is one frame: a fixed header (magic, version, message type,
+flags, payload length) followed by the payload. A payload is a list of named
+fields, each with a type code, a shape and the packed little-endian values,
+so numpy arrays go on the wire as raw bytes and are read back without any
+Python literal parsing. Only the standard library is needed to decode.
+result_to_dict() turns the fields of a result into the Stats/Differences/
+Anomalies dictionary that the gateway publishes and Isum.db stores.
+
+This file is shared verbatim by IsumAndrasperry/ and mqtt_clientAndUART/;
+check_shared_modules.py verifies the copies.
+"""
+
+import asyncio
+import struct
+
+MAGIC = b'ISUM'
+VERSION = 1
+
+# Message types
+MSG_RESULT = 1             # One analysis result
+MSG_REQUEST_LATEST = 2     # Client -> server: send the latest result now
+MSG_SUBSCRIBE = 3          # Client -> server: push every new result
+MSG_UNSUBSCRIBE = 4        # Client -> server: stop pushing results
+MSG_NO_RESULT = 5          # Server -> client: no result available yet
+
+HEADER = struct.Struct('<4sBBHI')  # magic, version, type, flags, payload length
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Field type codes are the struct format character of one element
+_CODE_DTYPES = {'d': '<f8', 'f': '<f4', 'q': '<i8', 'B': 'u1', '?': '?'}
+_STRING = 's'
+
+class ProtocolError(ValueError):
+    """Raised when a frame is malformed or of an unsupported version."""
+
+def _numpy_code(dtype):
+    if dtype.kind == 'b':
+        return '?'
+    if dtype.kind == 'f':
+        return 'f' if dtype.itemsize <= 4 else 'd'
+    if dtype.kind == 'u' and dtype.itemsize == 1:
+        return 'B'
+    return 'q'
+
+def _encode_field(name, value):
+    name = name.encode('utf-8')
+    out = [struct.pack('<B', len(name)), name]
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(struct.pack('<cBI', _STRING.encode(), 1, len(data)))
+        out.append(data)
+        return b''.join(out)
+
+    if hasattr(value, 'dtype'):
+        # numpy array or scalar: send the raw buffer
+        code = _numpy_code(value.dtype)
+        shape = tuple(value.shape)
+        data = value.astype(_CODE_DTYPES[code], copy=False).tobytes(order='C')
+    else:
+        if isinstance(value, bool):
+            code = '?'
+        elif isinstance(value, int):
+            code = 'q'
+        else:
+            code = 'd'
+        shape = ()
+        data = struct.pack('<' + code, value)
+
+    out.append(struct.pack('<cB', code.encode(), len(shape)))
+    out.append(struct.pack('<%dI' % len(shape), *shape))
+    out.append(data)
+    return b''.join(out)
+
+def encode_payload(fields):
+    """Pack a {name: value} dict of numpy arrays, numbers and strings."""
+    parts = [struct.pack('<H', len(fields))]
+    for name, value in fields.items():
+        parts.append(_encode_field(name, value))
+    return b''.join(parts)
+
+def _reshape(values, shape):
+    if len(shape) <= 1:
+        return list(values) if shape else values[0]
+    step = len(values) // shape[0]
+    return [_reshape(values[i * step:(i + 1) * step], shape[1:]) for i in range(shape[0])]
+
+def decode_payload(payload):
+    """Unpack a payload into a {name: value} dict of nested lists, numbers and strings."""
+    view = memoryview(payload)
+    try:
+        (count,) = struct.unpack_from('<H', view, 0)
+        offset = 2
+        fields = {}
+        for _ in range(count):
+            (name_len,) = struct.unpack_from('<B', view, offset)
+            offset += 1
+            name = bytes(view[offset:offset + name_len]).decode('utf-8')
+            offset += name_len
+            code, ndim = struct.unpack_from('<cB', view, offset)
+            code = code.decode()
+            offset += 2
+            if code == _STRING:
+                (length,) = struct.unpack_from('<I', view, offset)
+                offset += 4
+                fields[name] = bytes(view[offset:offset + length]).decode('utf-8')
+                offset += length
+                continue
+            shape = struct.unpack_from('<%dI' % ndim, view, offset)
+            offset += 4 * ndim
+            count_values = 1
+            for dim in shape:
+                count_values *= dim
+            fmt = '<%d%s' % (count_values, code)
+            values = struct.unpack_from(fmt, view, offset)
+            offset += struct.calcsize(fmt)
+            fields[name] = _reshape(values, shape)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed payload: {e}") from e
+    return fields
+
+def _channel_table(rows, metric_names):
+    """[[v, ...], ...] per channel -> {'Channel N': {metric: v}}"""
+    return {f'Channel {idx + 1}': dict(zip(metric_names, row)) for idx, row in enumerate(rows)}
+
+def result_to_dict(fields):
+    """Convert the fields of a result frame into the Stats/Differences/Anomalies dictionary."""
+    metric_names = fields['stat_metrics'].split(',')
+    anomalies = {}
+    for idx, flags in enumerate(fields['anomalies']):
+        flagged = {
+            metric: (fields['stats_old'][idx][m], fields['stats_new'][idx][m])
+            for m, metric in enumerate(metric_names) if flags[m]
+        }
+        if flagged:
+            anomalies[f'Channel {idx + 1}'] = flagged
+
+    result = {
+        'Stats': {
+            'New File': _channel_table(fields['stats_new'], metric_names),
+            'Old File': _channel_table(fields['stats_old'], metric_names)
+        },
+        'Differences': _channel_table(fields['differences'], metric_names),
+        'Anomalies': anomalies or None,
+        'Spectral': {
+            'Bands': fields['bands'],
+            'Band Energy': fields['band_energy'],
+            'Band Energy Ratio': fields['band_energy_ratio'],
+            'Peak Frequency': fields['peak_frequency'],
+            'Centroid': fields['centroid']
+        },
+        'Counter': fields['counter'],
+        'Timestamp': fields['timestamp']
+    }
+    if 'drift' in fields:
+        drift = {
+            f'Channel {idx + 1}': [metric for m, metric in enumerate(metric_names) if flags[m]]
+            for idx, flags in enumerate(fields['drift']) if any(flags)
+        }
+        result['Drift'] = drift or None
+    if 'transient_channel' in fields:
+        transients = [
+            {'Channel': int(channel) + 1, 'Time': time, 'Duration': duration,
+             'Band': fields['bands'][band], 'Score': score}
+            for channel, time, duration, band, score in zip(
+                fields['transient_channel'], fields['transient_time'], fields['transient_duration'],
+                fields['transient_band'], fields['transient_score'])
+        ]
+        result['Transients'] = transients or None
+    if 'class' in fields:
+        result['Classification'] = {
+            'Class': fields['class'],
+            'Score A': fields['class_score_a'],
+            'Score B': fields['class_score_b'],
+            'Margin': fields['class_margin']
+        }
+    return result
+
+def encode_frame(msg_type, payload=b''):
+    """Header plus payload, ready to be written to the socket."""
+    return HEADER.pack(MAGIC, VERSION, msg_type, 0, len(payload)) + payload
+
+def parse_header(header):
+    """Return (msg_type, payload_length) of a frame header."""
+    magic, version, msg_type, _flags, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {length} bytes")
+    return msg_type, length
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return bytes(buffer)
+
+def read_frame(sock):
+    """Read exactly one frame from a blocking socket; returns (msg_type, payload)."""
+    msg_type, length = parse_header(_recv_exactly(sock, HEADER.size))
+    return msg_type, _recv_exactly(sock, length) if length else b''
+
+async def read_frame_async(reader):
+    """Read exactly one frame from an asyncio StreamReader; returns (msg_type, payload)."""
+    try:
+        msg_type, length = parse_header(await reader.readexactly(HEADER.size))
+        return msg_type, await reader.readexactly(length) if length else b''
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("Connection closed by peer") from e
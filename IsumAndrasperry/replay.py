@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline replay of archived ISUM captures into the Isum.db message store.
+
+Runs the analysis of shmAnomali over a directory of .bin captures, or over
+the compressed CaptureArchive that shmAnomali keeps (a directory of .seg/.idx
+segments, read in place), oldest first, pairing every capture with the
+previous one as the live loop does.
+The per-capture work (preprocessing, statistics, FFT, STFT, classification)
+runs in a process pool; the pairing, the rolling baseline and the anomaly rule
+are applied in order in the main process. Every result is stored with the payload
+the gateway publishes, through the same isum_db schema as sub2_mqtt.
+
+A checkpoint (last capture, counter and baseline state) is written in the
+same transaction as every batch, so an interrupted replay resumes where it
+stopped without duplicating rows; --restart replays the range from scratch,
+replacing the results stored by the earlier replay.
+
+    python3 replay.py /archive/isum --db ../mqtt_subAndSqlite/Isum.db --since 2024-06-01 --until 2024-07-01
+    python3 replay.py ./archive --db ../mqtt_subAndSqlite/Isum.db --since 2024-06-01
+"""
+
+import argparse
+import io
+import json
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import isum_db
+import isum_protocol
+import shmAnomali
+from capture_archive import CaptureArchive, format_timestamp, parse_date
+from rolling_baseline import RollingBaseline
+
+REPLAY_TOPIC = 'replay/test/topic'
+
+def list_captures(directory, since=None, until=None):
+    """(mtime_ns, path) of every .bin capture under `directory` modified in [since, until), oldest first."""
+    captures = []
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(root, name)
+            mtime = os.stat(path).st_mtime_ns
+            if (since is None or mtime >= since) and (until is None or mtime < until):
+                captures.append((mtime, path))
+    captures.sort()
+    return captures
+
+def is_archive(directory):
+    """True if `directory` holds a CaptureArchive (.seg/.idx segments) rather than .bin captures."""
+    return any(name.endswith('.idx') for name in os.listdir(directory))
+
+def list_archived(archive, since=None, until=None):
+    """(timestamp_ns, name) of every capture of a CaptureArchive in [since, until), oldest first."""
+    return [(timestamp, format_timestamp(timestamp)) for timestamp in archive.timestamps(since, until)]
+
+# CaptureArchive of every worker, opened on first use
+_archives = {}
+
+def read_capture(capture, archive_dir=None):
+    """The (channels, samples) array of a .bin path, or of a timestamp of the archive in archive_dir."""
+    if archive_dir is None:
+        return shmAnomali.read_and_reshape(capture)
+    archive = _archives.get(archive_dir)
+    if archive is None:
+        archive = _archives[archive_dir] = CaptureArchive(archive_dir)
+    return archive.read(capture)
+
+def _init_worker():
+    # Ctrl+C is handled by the main process only
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def extract(captures, archive_dir=None):
+    """Features of a chunk of captures (runs in a worker): (stats, spectral, classification, transients) or None."""
+    classifier = shmAnomali.get_classifier()
+    features = []
+    for capture in captures:
+        try:
+            data = read_capture(capture, archive_dir)
+            result = shmAnomali.analysis_features(data)
+            classification = classifier.classify(data) if classifier is not None else None
+            features.append((result['stats'], result['spectral'], classification, result.get('transients')))
+        except (OSError, ValueError, KeyError) as e:
+            # KeyError: the archive evicted the capture since it was listed
+            print(f"Captura {capture} omitida: {e}")
+            features.append(None)
+    return features
+
+def iter_features(pool, captures, chunk, ahead, archive_dir=None):
+    """Features of `captures` (paths, or timestamps of archive_dir) in order, keeping at most `ahead` chunks in flight."""
+    pending = deque()
+    chunks = (captures[start:start + chunk] for start in range(0, len(captures), chunk))
+    for part in chunks:
+        pending.append(pool.submit(extract, part, archive_dir))
+        if len(pending) >= ahead:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+def init_checkpoints(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS replay_checkpoints (
+            source TEXT PRIMARY KEY,
+            last_mtime_ns INTEGER NOT NULL,
+            last_path TEXT NOT NULL,
+            counter INTEGER NOT NULL,
+            baseline BLOB NOT NULL,
+            updated DATETIME NOT NULL
+        )
+    ''')
+    conn.commit()
+
+def load_checkpoint(conn, source):
+    """(last_mtime_ns, last_path, counter, baseline) of the replay of `source`, or None."""
+    return conn.execute('SELECT last_mtime_ns, last_path, counter, baseline FROM replay_checkpoints WHERE source = ?',
+                        (source,)).fetchone()
+
+def save_checkpoint(conn, source, last_mtime_ns, last_path, counter, baseline):
+    buffer = io.BytesIO()
+    np.savez(buffer, **baseline.state())
+    conn.execute('INSERT OR REPLACE INTO replay_checkpoints VALUES (?, ?, ?, ?, ?, ?)',
+                 (source, last_mtime_ns, last_path, counter, buffer.getvalue(), isum_db.utc_timestamp()))
+
+def new_baseline():
+    return RollingBaseline((shmAnomali.CAPTURE_SHAPE[0], len(shmAnomali.STAT_METRICS)), shmAnomali.BASELINE_WINDOW)
+
+def analyze_pair(counter, path, mtime_ns, features_new, features_old, baseline):
+    """The analysis of shmAnomali.analyze_files on precomputed features, as a gateway payload dict."""
+    stats_new, spectral_new, classification, transients = features_new
+    stats_old, spectral_old, _, _ = features_old
+    differences = shmAnomali.compare_statistics(stats_new, stats_old)
+    fft_differences = shmAnomali.spectral_differences(spectral_new, spectral_old)
+    anomalies = shmAnomali.detect_anomalies(stats_new, stats_old, baseline=baseline)
+    drift = shmAnomali.update_baseline(baseline, stats_new, anomalies, path=None)
+    result = shmAnomali.build_result(counter, path, stats_new, stats_old, differences, anomalies, fft_differences,
+                                     classification, drift, transients)
+    result['timestamp'] = mtime_ns / 1e9  # Capture time, not replay time
+    # Same conversion as the gateway applies to a result frame
+    shm_data = isum_protocol.result_to_dict(isum_protocol.decode_payload(isum_protocol.encode_payload(result)))
+    return {'Alert': 1 if shm_data['Anomalies'] else 0} | shm_data
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='Folder with the archived .bin captures (searched recursively), '
+                                          'or a CaptureArchive directory')
+    parser.add_argument('--db', default=isum_db.DB_PATH)
+    parser.add_argument('--since', type=parse_date, help='First capture date (UTC), e.g. 2024-06-01')
+    parser.add_argument('--until', type=parse_date, help='End date (UTC), exclusive')
+    parser.add_argument('--topic', default=REPLAY_TOPIC)
+    parser.add_argument('--letter', help='position_letter stored with every result')
+    parser.add_argument('--number', type=int, help='position_number stored with every result')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk', type=int, default=16, help='Captures per worker task')
+    parser.add_argument('--batch-size', type=int, default=500, help='Results per transaction and checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint and replay everything, replacing the results stored '
+                             'earlier on --topic between --since and --until')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.directory)
+    conn = isum_db.connect(args.db)
+    isum_db.init_db(conn)
+    init_checkpoints(conn)
+
+    if args.restart:
+        # A new replay of the range replaces the previous one instead of doubling its messages and rollups
+        since, until = (None if ns is None else isum_db.utc_timestamp(ns / 1e9) for ns in (args.since, args.until))
+        with conn:
+            deleted = isum_db.delete_messages(conn, args.topic, since, until)
+            conn.execute('DELETE FROM replay_checkpoints WHERE source = ?', (source,))
+        print(f'{deleted} resultados anteriores de {args.topic} eliminados')
+
+    # Archived captures are identified by their timestamp, .bin captures by their path and mtime
+    archive_dir = source if is_archive(source) else None
+    if archive_dir is None:
+        captures = list_captures(source, args.since, args.until)
+    else:
+        archive = CaptureArchive(archive_dir)
+        captures = list_archived(archive, args.since, args.until)
+    baseline = new_baseline()
+    counter = 0
+    checkpoint = None if args.restart else load_checkpoint(conn, source)
+    if checkpoint is not None:
+        last_mtime, last_path, counter, state = checkpoint
+        with np.load(io.BytesIO(state)) as saved:
+            baseline.set_state(saved)
+        # Resume after the last stored capture, which is analyzed again only to pair it with the next one
+        captures = [(mtime, path) for mtime, path in captures if (mtime, path) > (last_mtime, last_path)]
+        if archive_dir is None:
+            previous_kept = os.path.exists(last_path)
+        else:
+            previous_kept = bool(archive.timestamps(last_mtime, last_mtime + 1))
+        if previous_kept:
+            captures.insert(0, (last_mtime, last_path))
+        print(f'Reanudando despues de {last_path} ({counter} resultados ya guardados)')
+    if not captures:
+        print('No hay capturas nuevas que procesar')
+        return
+
+    position = {}
+    if args.letter is not None and args.number is not None:
+        position = {'position_letter': args.letter, 'position_number': args.number}
+
+    started = time.time()
+    previous = None  # Features of the previous capture; the first capture only starts the pairing
+    stored = skipped = 0
+    batch = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        keys = [path if archive_dir is None else mtime for mtime, path in captures]
+        for (mtime, path), features in zip(captures, iter_features(pool, keys, args.chunk, 2 * args.workers,
+                                                                   archive_dir)):
+            if features is None:
+                skipped += 1
+                continue
+            if previous is not None:
+                counter += 1
+                payload = position | analyze_pair(counter, path, mtime, features, previous, baseline)
+                batch.append((args.topic, json.dumps(payload), isum_db.utc_timestamp(mtime / 1e9), payload))
+            previous = features
+
+            if len(batch) >= args.batch_size:
+                with conn:
+                    isum_db.add_messages(conn, batch)
+                    save_checkpoint(conn, source, mtime, path, counter, baseline)
+                stored += len(batch)
+                batch = []
+                rate = stored / max(time.time() - started, 1e-9)
+                print(f'{counter} resultados guardados ({rate:.0f} capturas/s), ultima captura {path}')
+
+        if batch:
+            with conn:
+                isum_db.add_messages(conn, batch)
+                save_checkpoint(conn, source, mtime, path, counter, baseline)
+            stored += len(batch)
+
+    conn.close()
+    print(f'Replay terminado: {stored} resultados nuevos en {args.db}, {skipped} capturas omitidas, '
+          f'{time.time() - started:.1f} s')
+
+if __name__ == '__main__':
+    main()
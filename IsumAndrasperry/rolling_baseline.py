@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rolling multi-capture baseline for the anomaly detector.
+
+Keeps the per-channel features of the last K captures in a fixed NumPy ring
+buffer together with their running sum and sum of squares, so the window mean
+and variance are updated in O(1) per capture whatever K is. An EWMA mean and
+variance track slow drift alongside. The state is saved to disk so a restart
+does not lose the baseline.
+"""
+
+import os
+import numpy as np
+
+class RollingBaseline:
+
+    def __init__(self, shape, window=30, alpha=0.1, min_samples=5):
+        """
+        shape: shape of the feature array of one capture, e.g. (channels, metrics)
+        window: number of captures K in the rolling window
+        alpha: EWMA smoothing factor
+        min_samples: captures needed before z-scores are reported
+        """
+        self.shape = tuple(shape)
+        self.window = window
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.buffer = np.zeros((window,) + self.shape)
+        self.sum = np.zeros(self.shape)
+        self.sum_sq = np.zeros(self.shape)
+        self.ewma_mean = np.zeros(self.shape)
+        self.ewma_var = np.zeros(self.shape)
+        self.count = 0  # Captures currently in the window
+        self.position = 0  # Next slot of the ring buffer
+        self.updates = 0  # Captures seen since the baseline was created
+        self.flagged_in_row = 0  # Consecutive captures the caller left out as anomalous
+
+    def update(self, features):
+        """Add the features of a new capture, evicting the oldest one when the window is full."""
+        features = np.asarray(features, dtype=np.float64)
+        if self.count == self.window:
+            evicted = self.buffer[self.position]
+            self.sum -= evicted
+            self.sum_sq -= evicted * evicted
+        else:
+            self.count += 1
+        self.buffer[self.position] = features
+        self.sum += features
+        self.sum_sq += features * features
+        self.position = (self.position + 1) % self.window
+
+        if self.updates == 0:
+            self.ewma_mean[...] = features
+        else:
+            delta = features - self.ewma_mean
+            self.ewma_mean += self.alpha * delta
+            self.ewma_var = (1 - self.alpha) * (self.ewma_var + self.alpha * delta * delta)
+        self.updates += 1
+
+        # Resynchronize the running sums once per window so rounding errors cannot build up
+        if self.position == 0:
+            valid = self.buffer[:self.count]
+            self.sum = valid.sum(axis=0)
+            self.sum_sq = (valid * valid).sum(axis=0)
+
+    @property
+    def ready(self):
+        return self.count >= self.min_samples
+
+    @property
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    @property
+    def variance(self):
+        mean = self.mean
+        return np.maximum(self.sum_sq / max(self.count, 1) - mean * mean, 0.0)
+
+    def zscores(self, features):
+        """z-score of the features against the window mean and standard deviation."""
+        std = np.sqrt(self.variance)
+        return (np.asarray(features) - self.mean) / np.where(std > 0, std, np.inf)
+
+    def ewma_zscores(self, features):
+        """z-score of the features against the EWMA mean and standard deviation."""
+        std = np.sqrt(self.ewma_var)
+        return (np.asarray(features) - self.ewma_mean) / np.where(std > 0, std, np.inf)
+
+    def drift_scores(self):
+        """How far the EWMA mean has moved from the window mean, in window standard deviations.
+
+        The EWMA follows recent captures faster than the K-capture window, so a
+        slow drift shows up as a growing gap between the two.
+        """
+        std = np.sqrt(self.variance)
+        return (self.ewma_mean - self.mean) / np.where(std > 0, std, np.inf)
+
+    def state(self):
+        """Arrays holding the whole state, as saved by save()."""
+        return {'buffer': self.buffer, 'sum': self.sum, 'sum_sq': self.sum_sq,
+                'ewma_mean': self.ewma_mean, 'ewma_var': self.ewma_var,
+                'counters': np.array([self.count, self.position, self.updates, self.flagged_in_row])}
+
+    def set_state(self, state):
+        """Restore a state() mapping; returns False if it does not match the configured shape and window."""
+        if state['buffer'].shape != self.buffer.shape:
+            return False
+        self.buffer = state['buffer']
+        self.sum = state['sum']
+        self.sum_sq = state['sum_sq']
+        self.ewma_mean = state['ewma_mean']
+        self.ewma_var = state['ewma_var']
+        self.count, self.position, self.updates = (int(v) for v in state['counters'][:3])
+        if len(state['counters']) > 3:
+            self.flagged_in_row = int(state['counters'][3])
+        return True
+
+    def save(self, path):
+        """Write the state atomically (temporary file + rename)."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **self.state())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, shape, window=30, alpha=0.1, min_samples=5):
+        """Restore a saved baseline, or start a new one if there is none or it does not match."""
+        baseline = cls(shape, window, alpha, min_samples)
+        try:
+            with np.load(path) as state:
+                if not baseline.set_state(state):
+                    print(f"Linea base en {path} no coincide con la configuracion actual, se empieza de nuevo")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"No se pudo cargar la linea base de {path}: {e}")
+        return baseline
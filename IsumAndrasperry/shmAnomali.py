@@ -11,13 +11,81 @@ import os
 import signal
 import shutil
 import numpy as np
-import socket
+import asyncio
+import functools
+import json
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.recfunctions import structured_to_unstructured, unstructured_to_structured
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+import isum_protocol
+import metrics
+from capture_archive import CaptureArchive
+from rolling_baseline import RollingBaseline
+
+CAPTURE_SHAPE = (8, 16384)  # Channels x samples of every ISUM capture
+CYCLE_PERIOD = 10  # Seconds between the start of two captures
+METRICS_PORT = 9101  # /metrics endpoint when ISUM_METRICS is set
+CHANNEL_NAMES = [f'Channel {idx + 1}' for idx in range(CAPTURE_SHAPE[0])]
+
+# Analyzed captures go to a compressed archive (capture_archive.py) instead of being deleted
+ARCHIVE = True
+ARCHIVE_DIR = './archive'
+ARCHIVE_BUDGET = 2 * 1024 ** 3  # Bytes kept on the SD card; the oldest segments are evicted
+
+STAT_METRICS = ('Mean', 'Median', 'Std Dev', 'Variance')
+STATS_DTYPE = np.dtype([(metric, np.float64) for metric in STAT_METRICS])
+ANOMALY_DTYPE = np.dtype([(metric, np.bool_) for metric in STAT_METRICS])
+ANOMALY_STD_FACTOR = 2  # A metric is anomalous if it moves more than this many change_scale units
+THRESHOLD_FILE = './thresholds.json'  # Written by calibrate_threshold.py; overrides the defaults
+
+# Rolling baseline of the last captures, used by detect_anomalies once it is warm
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.npz')
+BASELINE_WINDOW = 30      # Captures in the rolling window
+BASELINE_Z_LIMIT = 3.0    # Default |z| of a metric against the window that counts as anomalous
+BASELINE_DRIFT_LIMIT = 2.0  # EWMA vs window gap, in window std devs, reported as drift
+BASELINE_READAPT = 10     # Consecutive flagged captures after which the shift is accepted as the new normal
+
+SAMPLE_RATE = 1000  # Hz, as in matlabCode/shm.m
+# Frequency bands (Hz) summarized by their energy; 10-100 Hz is the band of shm.m
+SPECTRAL_BANDS = ((0.5, 10), (10, 100), (100, 200), (200, 500))
+SPECTRAL_PEAKS = 3  # Dominant frequency components kept per channel
+
+# Short-time analysis: band energy over time inside each capture, to catch
+# short impacts or cracks that the whole-capture statistics average away
+TRANSIENTS = True          # Run the STFT stage on every capture
+STFT_WINDOW = 256          # Samples per frame (256 ms at 1 kHz)
+STFT_HOP = 128             # Samples between frames
+STFT_MAX_FRAMES = 256      # The hop grows for longer captures, so the cost stays bounded
+TRANSIENT_Z_LIMIT = 6.0    # Robust z of a frame's log band energy that flags a transient
+TRANSIENT_MAX_EVENTS = 8   # Strongest transients kept per capture
+TRANSIENT_DTYPE = np.dtype([('channel', np.int16), ('time', np.float32), ('duration', np.float32),
+                            ('band', np.int16), ('score', np.float32)])
+
+# Preprocessing of shm.m / umbral.m: trim both ends, then Butterworth band-pass
+PREPROCESS = True           # Analyze the preprocessed signal instead of the raw samples
+TRIM_FRACTION = 0.05        # Removed at each end of the signal before filtering
+PREPROCESS_BAND = (0.5, 200)  # Hz
+FILTER_ORDER = 4            # butter(4, ...) as in the MATLAB scripts
+# Captures at least this long are band-passed chunk by chunk (causal, float32) instead of whole
+STREAMING_MIN_SAMPLES = 4 * CAPTURE_SHAPE[1]
+STREAMING_CHUNK_SAMPLES = 16384
+ANALYSIS_DTYPE = np.float64  # np.float32 halves the analysis workspace; results move by ~1e-4 of the signal std
+
+# Spectral-correlation classifier (matlabCode/shm.m): reference captures of
+# healthy (Class A) and damaged (Class B) structures
+REFERENCE_FOLDER_A = './nodamage'
+REFERENCE_FOLDER_B = './damage'
+CLASSIFIER_CHANNEL = 0     # Channel 1, as in shm.m
+CLASSIFIER_SEGMENT = 0.25  # shm.m only uses the first 25% of the samples
 
 def run_command():
     """Run the specified command to initiate ISUM test."""
     command = ['./shm_project', '-x', 'shm.xclbin', '-t', 'simple', '-b', '1', '-P', 'tests_iot', '-C', '1'] # Simple test command
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with metrics.timer('capture'):
+            result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         print("Output:", result.stdout.decode())
         print("Errors:", result.stderr.decode())
     except subprocess.CalledProcessError as e:
@@ -29,19 +97,136 @@ def clean_directory(directory='./tests_iot'):
         shutil.rmtree(directory)
     os.makedirs(directory)
 
+@functools.lru_cache(maxsize=1)
+def get_archive():
+    """Capture archive of the process, or None if ARCHIVE is off."""
+    return CaptureArchive(ARCHIVE_DIR, ARCHIVE_BUDGET) if ARCHIVE else None
+
+def archive_capture(path):
+    """Append a capture to the archive (if enabled), then delete the file.
+
+    The file is only deleted once it is in the archive (or is not a valid
+    capture); after a write error it is kept and False is returned.
+    """
+    archive = get_archive()
+    if archive is not None:
+        try:
+            with metrics.timer('archive'):
+                if not archive.append_file(path, CAPTURE_SHAPE):
+                    print(f"{path} ya estaba archivado")
+        except FileNotFoundError:
+            return True
+        except ValueError as e:
+            print(f"Captura no valida, no se archiva {path}: {e}")
+            metrics.count('archive_error')
+        except OSError as e:
+            print(f"No se pudo archivar {path}, se conserva: {e}")
+            metrics.count('archive_error')
+            return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def archive_directory(directory='./tests_iot'):
+    """Archive the captures left in the directory, oldest first (before it is cleaned).
+
+    Returns False if any capture could not be archived (it is still in the directory).
+    """
+    if not os.path.isdir(directory):
+        return True
+    captures = [entry for entry in os.scandir(directory) if entry.name.endswith('.bin') and entry.is_file()]
+    archived = [archive_capture(entry.path) for entry in sorted(captures, key=lambda entry: entry.stat().st_mtime_ns)]
+    return all(archived)
+
+def archive_and_clean(directory='./tests_iot'):
+    """Archive the captures left in the directory and clean it, unless a capture could not be archived."""
+    if archive_directory(directory):
+        clean_directory(directory)
+    else:
+        print(f"Hay capturas sin archivar en {directory}: no se limpia el directorio")
+
+class CaptureWatcher:
+    """Track the captures of a directory with one os.scandir pass and an mtime watermark."""
+
+    def __init__(self, directory='./tests_iot', keep=2):
+        self.directory = directory
+        self.keep = keep
+        self.files = deque()  # Known captures, oldest first
+        self._watermark = 0
+        self._at_watermark = set()  # Names already seen with mtime == watermark
+
+    def poll(self):
+        """Return the paths of the captures that appeared since the last poll, oldest first."""
+        found = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.bin'):
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                if mtime > self._watermark or (mtime == self._watermark and entry.name not in self._at_watermark):
+                    found.append((mtime, entry.name, entry.path))
+        if not found:
+            return []
+        found.sort()
+        newest = found[-1][0]
+        if newest > self._watermark:
+            self._watermark = newest
+            self._at_watermark = set()
+        self._at_watermark.update(name for mtime, name, _ in found if mtime == newest)
+        paths = [path for _, _, path in found]
+        self.files.extend(paths)
+        return paths
+
+    def prune(self):
+        """Archive and delete the oldest captures so that only `keep` remain.
+
+        A capture that could not be archived stays first in line for the next prune.
+        """
+        while len(self.files) > self.keep:
+            if not archive_capture(self.files[0]):
+                break
+            self.files.popleft()
+
 def manage_files(directory='./tests_iot'):
-    """Ensure the directory contains no more than two files by deleting the oldest ones."""
+    """Ensure the directory contains no more than two files by archiving the oldest ones."""
     files = sorted(os.listdir(directory), key=lambda x: os.path.getctime(os.path.join(directory, x)))
     while len(files) > 2:
-        os.remove(os.path.join(directory, files.pop(0)))
+        path = os.path.join(directory, files.pop(0))
+        if path.endswith('.bin'):
+            archive_capture(path)
+        else:
+            os.remove(path)
 
 def read_and_reshape(file_path):
-    """Read binary data from the file and reshape it to the desired dimensions."""
-    with open(file_path, 'rb') as file:
-        content = file.read()
-        data = np.frombuffer(content, dtype=np.int16)
-        data = data.reshape((8, 16384))
-    return data
+    """Map the binary capture file as an (8, 16384) int16 array without copying it."""
+    return np.memmap(file_path, dtype=np.int16, mode='r', shape=CAPTURE_SHAPE)
+
+class FeatureCache:
+    """Small LRU cache of per-capture features keyed by path, size and mtime."""
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, file_path, name, compute):
+        """Return feature `name` of the capture, computing it with compute(data) on a miss."""
+        st = os.stat(file_path)
+        key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+        features = self._entries.get(key)
+        if features is None:
+            metrics.count('feature_cache_miss')
+            features = self._entries[key] = {}
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        if name not in features:
+            features[name] = compute(read_and_reshape(file_path))
+        return features[name]
+
+feature_cache = FeatureCache()
 
 def load_isum_files(folder_path):
     """Load the most recent and the second most recent ISUM files from the specified folder."""
@@ -61,180 +246,866 @@ def load_isum_files(folder_path):
 def signal_handler(sig, frame):
     """Handle the signal interrupt to clean up and exit the program."""
     print('Cleaning up and exiting...')
-    clean_directory()
+    archive_and_clean()
     exit(0)
 
-def calculate_statistics(data):
-    """Calculate and return statistical metrics for the given data."""
-    stats = {
-        'Mean': np.mean(data),
-        'Median': np.median(data),
-        'Std Dev': np.std(data),
-        'Variance': np.var(data)
-    }
+@functools.lru_cache(maxsize=16)
+def bandpass_sos(fs=SAMPLE_RATE, band=PREPROCESS_BAND, order=FILTER_ORDER):
+    """Second-order sections of the Butterworth band-pass, designed once per configuration."""
+    return butter(order, band, btype='bandpass', fs=fs, output='sos')
+
+def preprocess(data, fs=SAMPLE_RATE, band=PREPROCESS_BAND, trim=TRIM_FRACTION, dtype=np.float64):
+    """Trim `trim` of the samples at each end and band-pass every channel in one call.
+
+    Zero-phase filtering along the last axis, like filtfilt in the MATLAB scripts.
+    """
+    n = data.shape[-1]
+    remove = int(n * trim)
+    trimmed = np.asarray(data[..., remove:n - remove], dtype=dtype)
+    return sosfiltfilt(bandpass_sos(fs, band), trimmed, axis=-1)
+
+class StreamingBandpass:
+    """
+    Causal band-pass for captures too long to filter in one piece.
+
+    Chunks of (channels, samples) are filtered with the state carried over from
+    the previous chunk, so only one chunk is converted to floating point at a
+    time. Unlike preprocess() the filter is single-pass (not zero-phase).
+    """
+
+    def __init__(self, fs=SAMPLE_RATE, band=PREPROCESS_BAND, dtype=np.float32):
+        self.sos = bandpass_sos(fs, band).astype(dtype)
+        self.dtype = dtype
+        self.zi = None
+
+    def process(self, chunk):
+        x = np.asarray(chunk, dtype=self.dtype)
+        if self.zi is None:
+            # Start from the steady state for the first sample to avoid a step transient
+            self.zi = sosfilt_zi(self.sos).astype(self.dtype)[:, None, :] * x[None, :, :1]
+        y, self.zi = sosfilt(self.sos, x, axis=-1, zi=self.zi)
+        return y
+
+def filter_in_chunks(data, chunk_samples=16384, fs=SAMPLE_RATE, band=PREPROCESS_BAND, dtype=np.float32):
+    """Yield the band-passed signal of a (channels, samples) array, e.g. a memmap, chunk by chunk."""
+    stream = StreamingBandpass(fs, band, dtype)
+    for start in range(0, data.shape[-1], chunk_samples):
+        yield stream.process(data[..., start:start + chunk_samples])
+
+def preprocess_in_chunks(data, fs=SAMPLE_RATE, band=PREPROCESS_BAND, trim=TRIM_FRACTION, dtype=np.float32,
+                         chunk_samples=STREAMING_CHUNK_SAMPLES, out=None):
+    """preprocess() for long captures: trim, then band-pass with filter_in_chunks into `out`.
+
+    Only one chunk of `data` (e.g. a memmap) is converted at a time, so the
+    capture is never held whole in float64. Single-pass, so the signal is
+    delayed by the filter's phase, unlike the zero-phase preprocess().
+    """
+    n = data.shape[-1]
+    remove = int(n * trim)
+    trimmed = data[..., remove:n - remove]
+    if out is None:
+        out = np.empty(trimmed.shape, dtype=dtype)
+    start = 0
+    for chunk in filter_in_chunks(trimmed, chunk_samples, fs, band, dtype):
+        out[..., start:start + chunk.shape[-1]] = chunk
+        start += chunk.shape[-1]
+    return out
+
+def analysis_signal(data):
+    """Signal the statistics and spectra are computed on: preprocessed unless PREPROCESS is off.
+
+    Captures of STREAMING_MIN_SAMPLES or more go through preprocess_in_chunks.
+    """
+    if not PREPROCESS:
+        return data
+    if data.shape[-1] >= STREAMING_MIN_SAMPLES:
+        return preprocess_in_chunks(data)
+    return preprocess(data)
+
+def compute_statistics(data, scratch=None):
+    """Compute every statistical metric for all channels of a capture in one batched call.
+
+    Returns a structured array of STATS_DTYPE with one record per channel. If
+    given, `scratch` (an array of the shape of data) is overwritten by the
+    median partition instead of allocating a copy.
+    """
+    n = data.shape[1]
+    # Single pass: sum and sum of squares give mean and variance together
+    total = data.sum(axis=1, dtype=np.float64)
+    total_sq = np.einsum('ij,ij->i', data, data, dtype=np.float64)
+    mean = total / n
+    variance = np.maximum(total_sq / n - mean * mean, 0.0)
+
+    # Partition-based median instead of a full sort per channel
+    half = n // 2
+    kth = half if n % 2 else [half - 1, half]
+    if scratch is None:
+        part = np.partition(data, kth, axis=1)
+    else:
+        np.copyto(scratch, data)
+        scratch.partition(kth, axis=1)
+        part = scratch
+    if n % 2:
+        median = part[:, half].astype(np.float64)
+    else:
+        median = (part[:, half - 1].astype(np.float64) + part[:, half]) / 2
+
+    stats = np.empty(data.shape[0], dtype=STATS_DTYPE)
+    stats['Mean'] = mean
+    stats['Median'] = median
+    stats['Std Dev'] = np.sqrt(variance)
+    stats['Variance'] = variance
     return stats
 
-def compute_statistics(data_new, data_old):
-    """Compute and return statistics for new and old data."""
-    stats = {
-        'New File': {
-            'Channel 1': calculate_statistics(data_new[0]),
-            'Channel 2': calculate_statistics(data_new[1])
-        },
-        'Old File': {
-            'Channel 1': calculate_statistics(data_old[0]),
-            'Channel 2': calculate_statistics(data_old[1])
+def file_statistics(file_path):
+    """Statistics of one capture file, computed once and then served from the cache."""
+    return file_features(file_path)['stats']
+
+def analysis_features(data):
+    """Statistics, spectral features and transients of a capture, computed in the workspace of the process."""
+    return get_workspace(tuple(data.shape)).features(data)
+
+def file_features(file_path):
+    """Features of a capture file, computed once and then served from the cache."""
+    return feature_cache.get(file_path, 'features', analysis_features)
+
+def compute_file_statistics(file_new, file_old):
+    """Return the statistics of the new and the old file, reusing cached results."""
+    return file_statistics(file_new), file_statistics(file_old)
+
+def compare_statistics(stats_new, stats_old):
+    """Return the per-channel difference (new - old) of every metric."""
+    differences = np.empty(len(stats_new), dtype=STATS_DTYPE)
+    for metric in STAT_METRICS:
+        differences[metric] = stats_new[metric] - stats_old[metric]
+    return differences
+
+def stats_to_dict(stats):
+    """Nested {'Channel N': {metric: value}} form of a per-channel structured array."""
+    return {
+        CHANNEL_NAMES[idx]: {metric: stats[metric][idx].item() for metric in stats.dtype.names}
+        for idx in range(len(stats))
+    }
+
+def anomalies_to_dict(anomalies, stats_new, stats_old):
+    """{'Channel N': {metric: (old, new)}} for the flagged channels and metrics only."""
+    result = {}
+    for idx in np.flatnonzero(anomaly_mask(anomalies)):
+        result[CHANNEL_NAMES[idx]] = {
+            metric: (stats_old[metric][idx].item(), stats_new[metric][idx].item())
+            for metric in STAT_METRICS if anomalies[metric][idx]
         }
+    return result
+
+@functools.lru_cache(maxsize=8)
+def rfft_frequencies(n, fs=SAMPLE_RATE):
+    """Frequency axis (Hz) of an n-point rfft, built once per (n, fs)."""
+    freqs = np.fft.rfftfreq(n, 1.0 / fs)
+    freqs.flags.writeable = False
+    return freqs
+
+@functools.lru_cache(maxsize=8)
+def band_weights(n, fs=SAMPLE_RATE, bands=SPECTRAL_BANDS):
+    """(bands, bins) matrix turning an rfft power spectrum into time-domain band energies.
+
+    The one-sided bins are weighted so that, by Parseval, a band's energy equals
+    sum(x**2) of the signal after an ideal band-pass filter (bandEnergy in shm.m).
+    """
+    freqs = rfft_frequencies(n, fs)
+    one_sided = np.full(freqs.shape, 2.0 / n)
+    one_sided[0] = 1.0 / n
+    if n % 2 == 0:
+        one_sided[-1] = 1.0 / n
+    weights = np.zeros((len(bands), len(freqs)))
+    for idx, (low, high) in enumerate(bands):
+        in_band = (freqs >= low) & (freqs < high)
+        weights[idx, in_band] = one_sided[in_band]
+    weights.flags.writeable = False
+    return weights
+
+def perform_fft(data, fs=SAMPLE_RATE):
+    """Real FFT of every channel at once; returns the frequencies (Hz) and amplitudes."""
+    return rfft_frequencies(data.shape[-1], fs), np.abs(np.fft.rfft(data, axis=-1))
+
+def spectral_features(data, fs=SAMPLE_RATE, bands=SPECTRAL_BANDS, n_peaks=SPECTRAL_PEAKS, full_spectrum=False):
+    """Compact spectral summary of all channels of a capture.
+
+    Returns a dict with the energy per band, the n_peaks strongest non-DC
+    components and the spectral centroid of every channel; the full spectrum is
+    only included when full_spectrum is True.
+    """
+    freqs, amplitude = perform_fft(data, fs)
+    power = amplitude * amplitude
+
+    # Strongest bins, ignoring DC, ordered from the largest down
+    candidates = amplitude[:, 1:]
+    top = np.argpartition(candidates, -n_peaks, axis=1)[:, -n_peaks:]
+    order = np.argsort(-np.take_along_axis(candidates, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1) + 1
+
+    total = amplitude.sum(axis=1)
+    features = {
+        'Band Energy': power @ band_weights(data.shape[-1], fs, bands).T,
+        'Peak Frequency': freqs[top],
+        'Peak Amplitude': np.take_along_axis(amplitude, top, axis=1),
+        'Centroid': (amplitude @ freqs) / np.where(total > 0, total, 1.0),
     }
-    return stats
+    if full_spectrum:
+        features['Frequency'] = freqs
+        features['Amplitude'] = amplitude
+    return features
 
-def compare_statistics(stats):
-    """Compare and return differences in statistics between new and old data."""
-    differences = {'Channel 1': {}, 'Channel 2': {}}
-    for channel in ['Channel 1', 'Channel 2']:
-        for metric in ['Mean', 'Median', 'Std Dev', 'Variance']:
-            new_value = stats['New File'][channel][metric]
-            old_value = stats['Old File'][channel][metric]
-            if new_value != old_value:
-                differences[channel][metric] = (old_value, new_value)
-    return differences
+@functools.lru_cache(maxsize=4)
+def stft_window(n):
+    """Hann window of the STFT frames, built once per length."""
+    window = np.hanning(n)
+    window.flags.writeable = False
+    return window
+
+def stft_hop(n, window=STFT_WINDOW, hop=STFT_HOP, max_frames=STFT_MAX_FRAMES):
+    """Hop between the STFT frames of an n-sample signal: `hop`, or larger so there are at most max_frames."""
+    return max(hop, -(-(n - window) // max(max_frames - 1, 1)))
+
+def stft_band_energy(data, fs=SAMPLE_RATE, bands=SPECTRAL_BANDS, window=STFT_WINDOW, hop=STFT_HOP,
+                     max_frames=STFT_MAX_FRAMES):
+    """Energy per band of every channel over time, as a (channels, frames, bands) array, and the hop used.
+
+    The frames are a strided view of the signal (no copy); all channels and
+    frames go through one rfft call. Every frame has its mean removed, so the
+    raw capture can be used. At most max_frames frames are computed.
+    """
+    n = data.shape[-1]
+    if n < window:
+        return np.zeros(data.shape[:-1] + (0, len(bands))), hop
+    hop = stft_hop(n, window, hop, max_frames)
+    frames = sliding_window_view(data, window, axis=-1)[..., ::hop, :]
+    spectrum = np.fft.rfft((frames - frames.mean(axis=-1, keepdims=True)) * stft_window(window), axis=-1)
+    power = spectrum.real * spectrum.real + spectrum.imag * spectrum.imag
+    return power @ band_weights(window, fs, bands).T, hop
+
+def detect_transients(energy, hop, fs=SAMPLE_RATE, window=STFT_WINDOW, offset=0,
+                      z_limit=TRANSIENT_Z_LIMIT, max_events=TRANSIENT_MAX_EVENTS):
+    """Localized bursts of band energy inside one capture.
+
+    Every (channel, band) log energy track is scored against its own median
+    with a robust z (MAD); consecutive frames of a channel above z_limit form
+    one event. Returns up to max_events TRANSIENT_DTYPE records, strongest
+    first, with the time (s) of the peak frame centre and the duration.
+    """
+    if energy.shape[1] == 0:
+        return np.zeros(0, dtype=TRANSIENT_DTYPE)
+    log_energy = np.log10(energy + 1e-12)
+    median = np.median(log_energy, axis=1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(log_energy - median), axis=1, keepdims=True)
+    # Floor of 0.05 decades, so a very steady track does not flag tiny wiggles
+    z = (log_energy - median) / np.maximum(mad, 0.05)
+    band = z.argmax(axis=2)
+    score = np.take_along_axis(z, band[..., None], axis=2)[..., 0]  # Strongest band of every frame
+    flagged = score > z_limit
+
+    events = []
+    for channel in np.flatnonzero(flagged.any(axis=1)):
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], flagged[channel].astype(np.int8), [0]))))
+        for start, stop in zip(edges[::2], edges[1::2]):
+            peak = start + int(np.argmax(score[channel, start:stop]))
+            events.append((channel, (offset + peak * hop + window / 2) / fs,
+                           ((stop - start - 1) * hop + window) / fs, band[channel, peak], score[channel, peak]))
+    events = np.array(events, dtype=TRANSIENT_DTYPE)
+    return events[np.argsort(-events['score'], kind='stable')[:max_events]]
+
+def _rfft_supports_out():
+    """np.fft.rfft writes into an `out` array from NumPy 2.0 on."""
+    try:
+        np.fft.rfft(np.zeros(4), out=np.empty(3, dtype=np.complex128))
+    except TypeError:
+        return False
+    return True
+
+RFFT_OUT = _rfft_supports_out()
+
+def rfft_into(data, out):
+    """rfft (norm='forward') of the last axis into `out`; before NumPy 2.0 it is allocated and copied."""
+    if RFFT_OUT:
+        return np.fft.rfft(data, axis=-1, norm='forward', out=out)
+    np.copyto(out, np.fft.rfft(data, axis=-1, norm='forward'))
+    return out
+
+class AnalysisWorkspace:
+    """
+    Buffers of the per-capture analysis, allocated once for a capture shape and
+    reused every cycle.
+
+    features() gives the result of the separate stages (analysis_signal,
+    compute_statistics, spectral_features, stft_band_energy) but the capture,
+    the trimmed signal, the spectra and the STFT frames live in preallocated
+    arrays, so a cycle only allocates the small per-capture results and the
+    temporaries of the band-pass filter (and, before NumPy 2.0, of the rfft
+    calls, see rfft_into). With dtype=np.float32 everything is
+    computed in single precision (sums are still accumulated in float64);
+    the results are float64 either way. Not thread-safe: one per process.
+    """
+
+    def __init__(self, shape=CAPTURE_SHAPE, dtype=ANALYSIS_DTYPE, fs=SAMPLE_RATE, bands=SPECTRAL_BANDS,
+                 n_peaks=SPECTRAL_PEAKS):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fs = fs
+        self.bands = bands
+        self.n_peaks = n_peaks
+        self.preprocess = PREPROCESS
+        channels, n = self.shape
+        self.remove = int(n * TRIM_FRACTION) if self.preprocess else 0
+        m = n - 2 * self.remove
+        bins = m // 2 + 1
+        complex_dtype = np.result_type(self.dtype, np.complex64)
+
+        self.raw = np.empty(self.shape, dtype=np.int16)
+        self.sos = bandpass_sos(fs).astype(self.dtype)
+        self.signal = np.empty((channels, m), dtype=self.dtype)
+        self.scratch = np.empty((channels, m), dtype=self.dtype)  # Median partition and peak search
+        self.spectrum = np.empty((channels, bins), dtype=complex_dtype)
+        self.amplitude = np.empty((channels, bins), dtype=self.dtype)
+        self.power = np.empty((channels, bins), dtype=self.dtype)
+        self.peak_mask = np.empty((channels, bins - 1), dtype=np.bool_)
+        self.freqs = rfft_frequencies(m, fs).astype(self.dtype)
+        # The spectra are computed with norm='forward' (scaled by 1/n): with the default norm numpy
+        # runs the float64 FFT and casts into `out`. The scale is folded back into the weights.
+        self.weights = (band_weights(m, fs, bands).T * m ** 2).astype(self.dtype)
+
+        # STFT of the raw capture
+        self.hop = stft_hop(n)
+        frames = len(range(0, n - STFT_WINDOW + 1, self.hop))
+        self.window = stft_window(STFT_WINDOW).astype(self.dtype)
+        self.frame_weights = (band_weights(STFT_WINDOW, fs, bands).T * STFT_WINDOW ** 2).astype(self.dtype)
+        self.frames = np.empty((channels, frames, STFT_WINDOW), dtype=self.dtype)
+        self.frame_mean = np.empty((channels, frames, 1), dtype=self.dtype)
+        self.frame_spectrum = np.empty((channels, frames, STFT_WINDOW // 2 + 1), dtype=complex_dtype)
+        self.frame_power = np.empty((channels, frames, STFT_WINDOW // 2 + 1), dtype=self.dtype)
 
-def perform_fft(data):
-    """Perform FFT on the data and return the frequencies and amplitudes."""
-    N = data.shape[0]
-    fft_data = np.fft.fft(data)
-    fft_freq = np.fft.fftfreq(N)
-    return fft_freq, np.abs(fft_data)
-
-def compare_fft(data_new, data_old):
-    """Compare FFT results between new and old data."""
-    differences = {'Channel 1': {}, 'Channel 2': {}}
-    for idx, channel in enumerate(['Channel 1', 'Channel 2']):
-        new_freq, new_ampl = perform_fft(data_new[idx])
-        old_freq, old_ampl = perform_fft(data_old[idx])
-        
-        differences[channel] = {
-            'New Frequency': new_freq,
-            'New Amplitude': new_ampl,
-            'Old Frequency': old_freq,
-            'Old Amplitude': old_ampl
+    @property
+    def nbytes(self):
+        """Size of the preallocated buffers."""
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def features(self, data):
+        """Same dict as analysis_features() for an int16 capture of the workspace shape."""
+        with metrics.timer('file_load'):
+            np.copyto(self.raw, data)  # Page the memmapped capture in
+        with metrics.timer('preprocess'):
+            signal_data = self.analysis_signal()
+        with metrics.timer('stats'):
+            stats = compute_statistics(signal_data, scratch=self.scratch)
+        with metrics.timer('fft'):
+            spectral = self.spectral_features(signal_data)
+        features = {'stats': stats, 'spectral': spectral}
+        if TRANSIENTS:
+            with metrics.timer('stft'):
+                # Raw samples: the band-pass edges would look like transients and it removes the high band
+                features['transients'] = detect_transients(self.stft_band_energy(), self.hop)
+        return features
+
+    def analysis_signal(self):
+        n = self.shape[1]
+        if self.preprocess and n >= STREAMING_MIN_SAMPLES:
+            # Long captures: filtered chunk by chunk straight into the signal buffer
+            return preprocess_in_chunks(self.raw, fs=self.fs, dtype=self.dtype, out=self.signal)
+        np.copyto(self.signal, self.raw[:, self.remove:n - self.remove], casting='unsafe')
+        if not self.preprocess:
+            return self.signal
+        return sosfiltfilt(self.sos, self.signal, axis=-1)
+
+    def spectral_features(self, data):
+        rfft_into(data, self.spectrum)
+        np.abs(self.spectrum, out=self.amplitude)
+        np.multiply(self.amplitude, self.amplitude, out=self.power)
+
+        # Strongest non-DC bins: n_peaks-th largest amplitude from a partition in the scratch buffer,
+        # then the bins above it ordered by channel and from the largest down
+        candidates = self.amplitude[:, 1:]
+        scratch = self.scratch[:, :candidates.shape[1]]
+        np.copyto(scratch, candidates)
+        scratch.partition(-self.n_peaks, axis=1)
+        np.greater_equal(candidates, scratch[:, -self.n_peaks, None], out=self.peak_mask)
+        rows, cols = np.nonzero(self.peak_mask)
+        order = np.lexsort((-candidates[rows, cols], rows))
+        rows, cols = rows[order], cols[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        top = cols[rank < self.n_peaks].reshape(len(data), self.n_peaks) + 1
+
+        total = self.amplitude.sum(axis=1, dtype=np.float64)
+        return {
+            'Band Energy': (self.power @ self.weights).astype(np.float64),
+            'Peak Frequency': rfft_frequencies(data.shape[-1], self.fs)[top],
+            'Peak Amplitude': np.take_along_axis(self.amplitude, top, axis=1) * np.float64(data.shape[-1]),
+            'Centroid': (self.amplitude @ self.freqs) / np.where(total > 0, total, 1.0),
         }
-    return differences
 
-def detect_anomalies(stats):
-    """Detect anomalies in the data based on statistical thresholds."""
-    anomalies = {'Channel 1': {}, 'Channel 2': {}}
-    for channel in ['Channel 1', 'Channel 2']:
-        mean_new = stats['New File'][channel]['Mean']
-        std_dev_new = stats['New File'][channel]['Std Dev']
-        mean_old = stats['Old File'][channel]['Mean']
-        std_dev_old = stats['Old File'][channel]['Std Dev']
-
-        # Detect significant deviations in mean and std deviation
-        if abs(mean_new - mean_old) > 2 * std_dev_old:
-            anomalies[channel]['Mean'] = (mean_old, mean_new)
-        if abs(std_dev_new - std_dev_old) > 2 * std_dev_old:
-            anomalies[channel]['Std Dev'] = (std_dev_old, std_dev_new)
-
-        # Add more checks for other statistics if necessary
-        for metric in ['Median', 'Variance']:
-            new_value = stats['New File'][channel][metric]
-            old_value = stats['Old File'][channel][metric]
-            if abs(new_value - old_value) > 2 * std_dev_old:
-                anomalies[channel][metric] = (old_value, new_value)
+    def stft_band_energy(self):
+        if self.frames.shape[1] == 0:
+            return np.zeros((self.shape[0], 0, len(self.bands)))
+        frames = sliding_window_view(self.raw, STFT_WINDOW, axis=-1)[..., ::self.hop, :]
+        np.mean(frames, axis=-1, keepdims=True, dtype=self.dtype, out=self.frame_mean)
+        np.subtract(frames, self.frame_mean, out=self.frames)
+        np.multiply(self.frames, self.window, out=self.frames)
+        rfft_into(self.frames, self.frame_spectrum)
+        np.abs(self.frame_spectrum, out=self.frame_power)
+        np.multiply(self.frame_power, self.frame_power, out=self.frame_power)
+        return self.frame_power @ self.frame_weights
+
+@functools.lru_cache(maxsize=2)
+def get_workspace(shape=CAPTURE_SHAPE, dtype=ANALYSIS_DTYPE):
+    """Analysis workspace of the process, built on first use for every capture shape."""
+    return AnalysisWorkspace(shape, dtype)
+
+def file_spectral_features(file_path):
+    """Spectral features of a capture file, computed once and then served from the cache."""
+    return file_features(file_path)['spectral']
+
+def compare_fft(data_new, data_old, full_spectrum=False):
+    """Compare the spectral features of new and old data."""
+    features_new = spectral_features(data_new, full_spectrum=full_spectrum)
+    features_old = spectral_features(data_old, full_spectrum=full_spectrum)
+    return spectral_differences(features_new, features_old)
+
+def compare_fft_files(file_new, file_old):
+    """Like compare_fft, but reusing the cached features of already analyzed files."""
+    return spectral_differences(file_spectral_features(file_new), file_spectral_features(file_old))
 
+def spectral_differences(features_new, features_old):
+    """Bundle new and old features with the per-band energy ratio new/old."""
+    energy_old = features_old['Band Energy']
+    ratio = features_new['Band Energy'] / np.where(energy_old > 0, energy_old, np.nan)
+    return {'New File': features_new, 'Old File': features_old, 'Band Energy Ratio': ratio}
+
+@functools.lru_cache(maxsize=1)
+def load_thresholds(path=THRESHOLD_FILE):
+    """Calibrated thresholds from calibrate_threshold.py, or None if the file does not exist."""
+    try:
+        with open(path) as f:
+            thresholds = json.load(f)
+    except FileNotFoundError:
+        return None
+    print(f"Umbrales calibrados cargados de {path}")
+    return thresholds
+
+def std_factors():
+    """Per-metric std factor: calibrated if available, ANOMALY_STD_FACTOR otherwise."""
+    thresholds = load_thresholds()
+    calibrated = thresholds.get('std_factor', {}) if thresholds else {}
+    return {metric: calibrated.get(metric, ANOMALY_STD_FACTOR) for metric in STAT_METRICS}
+
+def baseline_z_limits():
+    """Per-metric |z| limit against the baseline (STAT_METRICS order): calibrated if available, BASELINE_Z_LIMIT otherwise."""
+    thresholds = load_thresholds()
+    calibrated = thresholds.get('baseline_z_limit', {}) if thresholds else {}
+    return np.array([calibrated.get(metric, BASELINE_Z_LIMIT) for metric in STAT_METRICS])
+
+def detect_anomalies(stats_new, stats_old, factor=None, baseline=None):
+    """Flag the anomalous metrics of every channel of the new capture.
+
+    With a warm `baseline` (RollingBaseline of per-channel statistics) a metric
+    is anomalous when its |z| against the rolling window exceeds its calibrated
+    limit (baseline_z_limits). Otherwise it is anomalous when it moved more than
+    `factor` times its change_scale (old std dev, old variance for Variance)
+    from the previous capture; `factor` is a number or a {metric: factor} dict
+    and defaults to the calibrated factors of THRESHOLD_FILE. Returns a
+    structured array of ANOMALY_DTYPE with one record per channel.
+    """
+    if baseline is not None and baseline.ready:
+        zscores = baseline.zscores(structured_to_unstructured(stats_new))
+        return unstructured_to_structured(np.abs(zscores) > baseline_z_limits(), dtype=ANOMALY_DTYPE)
+
+    if factor is None:
+        factor = std_factors()
+    anomalies = np.zeros(len(stats_new), dtype=ANOMALY_DTYPE)
+    for metric in STAT_METRICS:
+        metric_factor = factor[metric] if isinstance(factor, dict) else factor
+        anomalies[metric] = (np.abs(stats_new[metric] - stats_old[metric]) >
+                             metric_factor * change_scale(stats_old, metric))
     return anomalies
 
-def start_server():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12345))  # Escucha en todas las interfaces, puerto 12345
-    server_socket.listen(1)
-    print('Servidor esperando conexiones...')
+def change_scale(stats_old, metric):
+    """Scale of the change of a metric between captures, in the units of the metric.
 
-    conn, addr = server_socket.accept()
-    print(f'Conexion establecida con {addr}')
+    The old std dev for Mean, Median and Std Dev; the old variance for Variance
+    (a variance difference compared with a std dev would flag almost every capture).
+    """
+    return stats_old['Variance'] if metric == 'Variance' else stats_old['Std Dev']
 
-    signal.signal(signal.SIGINT, signal_handler)
-    
-    counter = 0
-    clean_directory()  # Ensure the directory is clean before starting
-    
-    previous_new_stats = None  # Variable to store stats of new file for comparison
-
-    while True:
-        counter += 1
-        run_command()
-        print(f'Test #{counter} done!!')
-        manage_files()
-        
-        # Load the ISUM data files
+@functools.lru_cache(maxsize=2)
+def get_baseline(path=BASELINE_FILE):
+    """Rolling baseline of the per-channel statistics, restored from `path` once per process.
+
+    With path=None it starts empty and only lives in memory.
+    """
+    shape = (CAPTURE_SHAPE[0], len(STAT_METRICS))
+    if path is None:
+        return RollingBaseline(shape, BASELINE_WINDOW)
+    return RollingBaseline.load(path, shape, BASELINE_WINDOW)
+
+def update_baseline(baseline, stats_new, anomalies=None, path=BASELINE_FILE):
+    """Add the new capture to the baseline and persist it; returns the drift flags before the update.
+
+    While the baseline warms up every capture is added. Once it is warm, a
+    capture flagged against it (`anomalies`) is left out, so damage does not
+    become part of what is considered normal; after BASELINE_READAPT flagged
+    captures in a row the shift is taken as the new normal state and they are
+    added again. With path=None the baseline is only kept in memory.
+    """
+    drift = None
+    if baseline.ready:
+        drift = np.abs(baseline.drift_scores()) > BASELINE_DRIFT_LIMIT
+        if anomalies is not None and anomaly_mask(anomalies).any():
+            baseline.flagged_in_row += 1
+            if baseline.flagged_in_row < BASELINE_READAPT:
+                metrics.count('baseline_skipped')
+                return drift
+            metrics.count('baseline_readapt')
+        else:
+            baseline.flagged_in_row = 0
+    baseline.update(structured_to_unstructured(stats_new))
+    if path is None:
+        return drift
+    try:
+        baseline.save(path)
+    except OSError as e:
+        print(f"No se pudo guardar la linea base: {e}")
+    return drift
+
+def anomaly_mask(anomalies):
+    """Per-channel boolean: True if any metric of the channel is anomalous."""
+    mask = np.zeros(len(anomalies), dtype=bool)
+    for metric in anomalies.dtype.names:
+        mask |= anomalies[metric]
+    return mask
+
+def classifier_signal(data, channel=CLASSIFIER_CHANNEL, segment=CLASSIFIER_SEGMENT):
+    """Signal the classifier looks at, as in shm.m: readBinaryFile, preprocessSignal and butterworthFilter."""
+    signal_data = data[channel, :int(data.shape[1] * segment)]
+    if PREPROCESS:
+        return preprocess(signal_data)
+    remove = int(len(signal_data) * TRIM_FRACTION)
+    return signal_data[remove:len(signal_data) - remove]
+
+def normalized_spectrum(signals):
+    """Zero-mean, unit-norm magnitude spectra (last axis), so that a dot product is corrcoef."""
+    spectra = np.abs(np.fft.rfft(signals, axis=-1))
+    spectra -= spectra.mean(axis=-1, keepdims=True)
+    norms = np.linalg.norm(spectra, axis=-1, keepdims=True)
+    return (spectra / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+class SpectralClassifier:
+    """
+    Python port of the classification step of matlabCode/shm.m.
+
+    A new capture is assigned to the class whose reference captures have the
+    highest mean spectral correlation with it. The reference spectra are
+    normalized once, so scoring a capture against the whole bank is a single
+    matrix product.
+    """
+
+    def __init__(self, spectra_a, spectra_b, channel=CLASSIFIER_CHANNEL, threshold=0.0):
+        self.channel = channel
+        self.threshold = threshold  # Margin above which a capture is Class A (umbral.m)
+        self.bank = np.vstack([spectra_a, spectra_b])
+        self.is_a = np.zeros(len(self.bank), dtype=bool)
+        self.is_a[:len(spectra_a)] = True
+
+    @classmethod
+    def from_folders(cls, folder_a=REFERENCE_FOLDER_A, folder_b=REFERENCE_FOLDER_B, channel=CLASSIFIER_CHANNEL,
+                     threshold=0.0):
+        """Load the reference bank from the Class A and Class B capture folders."""
+        spectra = []
+        for folder in (folder_a, folder_b):
+            files = sorted(f for f in os.listdir(folder) if f.endswith('.bin'))
+            if not files:
+                raise ValueError(f"No hay archivos .bin de referencia en {folder}")
+            signals = np.stack([classifier_signal(read_and_reshape(os.path.join(folder, f)), channel) for f in files])
+            spectra.append(normalized_spectrum(signals))
+        return cls(spectra[0], spectra[1], channel, threshold)
+
+    def classify(self, data):
+        """Return the class ('A' healthy, 'B' damaged), the mean correlation with each class and the margin A - B.
+
+        The capture is Class A when the margin is above the calibrated threshold.
+        """
+        correlations = self.bank @ normalized_spectrum(classifier_signal(data, self.channel))
+        score_a = float(correlations[self.is_a].mean())
+        score_b = float(correlations[~self.is_a].mean())
+        return {
+            'Class': 'A' if score_a - score_b > self.threshold else 'B',
+            'Score A': score_a,
+            'Score B': score_b,
+            'Margin': score_a - score_b,
+        }
+
+@functools.lru_cache(maxsize=1)
+def get_classifier():
+    """Reference bank loaded once per process; None if the reference folders are not available."""
+    thresholds = load_thresholds() or {}
+    try:
+        return SpectralClassifier.from_folders(threshold=thresholds.get('correlation_threshold', 0.0))
+    except (OSError, ValueError) as e:
+        print(f"Clasificador espectral desactivado: {e}")
+        return None
+
+def build_result(counter, file_new, stats_new, stats_old, differences, anomalies, fft_differences,
+                 classification=None, drift=None, transients=None):
+    """Pack one analysis cycle into the fields of an isum_protocol result frame.
+
+    Per-channel tables are (channels, metrics) matrices in STAT_METRICS order.
+    """
+    features_new = fft_differences['New File']
+    result = {
+        'counter': counter,
+        'timestamp': time.time(),
+        'file': os.path.basename(file_new),
+        'stat_metrics': ','.join(STAT_METRICS),
+        'stats_new': structured_to_unstructured(stats_new),
+        'stats_old': structured_to_unstructured(stats_old),
+        'differences': structured_to_unstructured(differences),
+        'anomalies': structured_to_unstructured(anomalies),
+        'bands': np.asarray(SPECTRAL_BANDS, dtype=np.float64),
+        'band_energy': features_new['Band Energy'],
+        'band_energy_ratio': fft_differences['Band Energy Ratio'],
+        'peak_frequency': features_new['Peak Frequency'],
+        'peak_amplitude': features_new['Peak Amplitude'],
+        'centroid': features_new['Centroid'],
+    }
+    if drift is not None:
+        result['drift'] = drift
+    if transients is not None:
+        for name in TRANSIENT_DTYPE.names:
+            result[f'transient_{name}'] = transients[name]
+    if classification is not None:
+        result['class'] = classification['Class']
+        result['class_score_a'] = classification['Score A']
+        result['class_score_b'] = classification['Score B']
+        result['class_margin'] = classification['Margin']
+    return result
+
+def analyze_cycle(counter, directory='./tests_iot'):
+    """Analyze the two newest captures and return the result fields, or None if not possible.
+
+    One-off analysis (tests, benchmarks): the baseline is kept in memory and never saved.
+    """
+    # Load the ISUM data files
+    try:
+        data_new, data_old, file_new, file_old = load_isum_files(directory)
+    except ValueError as e:
+        print(e)
+        return None
+    return analyze_files(counter, file_new, file_old, baseline_path=None)
+
+def analyze_files(counter, file_new, file_old, baseline_path=BASELINE_FILE):
+    """Analyze a new capture against the previous one and return the result fields.
+
+    Runs in the analysis worker process; features of files it has already seen
+    come from that process' feature cache. The rolling baseline is restored
+    from and saved to `baseline_path` (None: in memory only).
+    """
+    try:
+        print(f"Datos cargados de: {file_new} y {file_old}")
+
+        # Calculate and display statistical metrics for all channels
+        stats_new, stats_old = compute_file_statistics(file_new, file_old)
+        for file_key, file_stats in (('New File', stats_new), ('Old File', stats_old)):
+            print(f"\n{file_key}:")
+            for channel_key, channel_stats in stats_to_dict(file_stats).items():
+                print(f"  {channel_key}: " + ", ".join(f"{metric} = {value:.4f}" for metric, value in channel_stats.items()))
+
+        # Compare statistics and display the differences
+        differences = compare_statistics(stats_new, stats_old)
+        print("\nDiferencias (nuevo - antiguo):")
+        for channel_key, channel_stats in stats_to_dict(differences).items():
+            print(f"  {channel_key}: " + ", ".join(f"{metric} = {value:.4f}" for metric, value in channel_stats.items()))
+
+        # Perform and compare frequency analysis
+        fft_differences = compare_fft_files(file_new, file_old)
+        features_new = fft_differences['New File']
+        bands = ", ".join(f"{low}-{high} Hz" for low, high in SPECTRAL_BANDS)
+        print(f"\nComponentes frecuenciales (energia por banda: {bands}):")
+        for idx, channel in enumerate(CHANNEL_NAMES):
+            energy = " ".join(f"{value:.3e}" for value in features_new['Band Energy'][idx])
+            ratio = " ".join(f"{value:.2f}" for value in fft_differences['Band Energy Ratio'][idx])
+            print(f"  {channel}: Energia = [{energy}], Ratio = [{ratio}], "
+                  f"Pico = {features_new['Peak Frequency'][idx][0]:.2f} Hz, "
+                  f"Centroide = {features_new['Centroid'][idx]:.2f} Hz")
+
+        # Detect anomalies against the rolling baseline (or the previous file while it warms up)
+        baseline = get_baseline(baseline_path)
+        anomalies = detect_anomalies(stats_new, stats_old, baseline=baseline)
+        drift = update_baseline(baseline, stats_new, anomalies, path=baseline_path)
+        if drift is not None and drift.any():
+            for idx in np.flatnonzero(drift.any(axis=1)):
+                drifted = [metric for m, metric in enumerate(STAT_METRICS) if drift[idx, m]]
+                print(f"\nDeriva lenta en {CHANNEL_NAMES[idx]}: {', '.join(drifted)}")
+        anomalies_detected = anomalies_to_dict(anomalies, stats_new, stats_old)
+        for channel, flagged in anomalies_detected.items():
+            print(f"\nAnomalias en {channel}:")
+            for metric, values in flagged.items():
+                old_value, new_value = values
+                print(f"  {metric}: Old = {old_value}, New = {new_value} (fuera del rango)")
+
+        transients = file_features(file_new).get('transients')
+        if transients is not None:
+            for event in transients:
+                low, high = SPECTRAL_BANDS[event['band']]
+                print(f"\nTransitorio en {CHANNEL_NAMES[event['channel']]}: t = {event['time']:.3f} s, "
+                      f"duracion = {event['duration']:.3f} s, banda {low}-{high} Hz, z = {event['score']:.1f}")
+
+        # Classify the new capture against the reference bank of shm.m
+        classification = None
+        classifier = get_classifier()
+        if classifier is not None:
+            classification = classifier.classify(read_and_reshape(file_new))
+            print(f"\nClasificacion: Clase {classification['Class']} "
+                  f"(A = {classification['Score A']:.4f}, B = {classification['Score B']:.4f}, "
+                  f"margen = {classification['Margin']:.4f})")
+
+        # Resultado listo para enviarse como trama binaria
+        return build_result(counter, file_new, stats_new, stats_old, differences, anomalies, fft_differences,
+                            classification, drift, transients)
+
+    except ValueError as e:
+        print(e)
+        return None
+
+class ResultServer:
+    """
+    Asyncio TCP service that fans analysis results out to any number of clients.
+
+    Every connection can send MSG_REQUEST_LATEST to get the latest result at
+    once, or MSG_SUBSCRIBE to receive every new result. Each client has its own
+    bounded queue; a slow client loses its oldest pending results instead of
+    holding back the others.
+    """
+
+    def __init__(self, host='0.0.0.0', port=12345, queue_size=8):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.latest = None  # Encoded frame of the latest result
+        self.subscribers = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        print(f'Servidor esperando conexiones en {self.host}:{self.port}...')
+
+    def publish(self, result):
+        """Encode a result once and queue it for every subscriber."""
+        with metrics.timer('encode'):
+            self.latest = isum_protocol.encode_frame(isum_protocol.MSG_RESULT, isum_protocol.encode_payload(result))
+        for queue in self.subscribers:
+            self._put_drop_oldest(queue, self.latest)
+
+    @staticmethod
+    def _put_drop_oldest(queue, frame):
+        if queue.full():
+            queue.get_nowait()
+            metrics.count('result_dropped')
+        queue.put_nowait(frame)
+
+    async def _send_loop(self, queue, writer):
+        while True:
+            frame = await queue.get()
+            started = time.perf_counter()
+            writer.write(frame)
+            await writer.drain()
+            metrics.observe('socket_send', time.perf_counter() - started)
+
+    async def _handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f'Conexion establecida con {addr}')
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        sender = asyncio.create_task(self._send_loop(queue, writer))
         try:
-            data_new, data_old, file_new, file_old = load_isum_files('./tests_iot')
-            print(f"Datos cargados de: {file_new} y {file_old}")
-            print(f"Forma de los datos nuevos: {data_new.shape}")
-            print(f"Forma de los datos antiguos: {data_old.shape}")
-            
-            # Calculate and display statistical metrics
-            stats = compute_statistics(data_new, data_old)
-            for file_key, channels in stats.items():
-                print(f"\n{file_key}:")
-                for channel_key, metrics in channels.items():
-                    print(f"  {channel_key}:")
-                    for metric, value in metrics.items():
-                        print(f"    {metric}: {value}")
-
-            # Compare statistics and display significant differences
-            differences = compare_statistics(stats)
-            for channel, metrics in differences.items():
-                print(f"\nDiferencias significativas en {channel}:")
-                for metric, values in metrics.items():
-                    old_value, new_value = values
-                    print(f"  {metric}: Old = {old_value}, New = {new_value}")
-
-            # Perform and compare frequency analysis
-            fft_differences = compare_fft(data_new, data_old)
-            for channel, metrics in fft_differences.items():
-                print(f"\nComponentes frecuenciales en {channel}:")
-                print(f"  New Frequencies: {metrics['New Frequency']}")
-                print(f"  New Amplitudes: {metrics['New Amplitude']}")
-                print(f"  Old Frequencies: {metrics['Old Frequency']}")
-                print(f"  Old Amplitudes: {metrics['Old Amplitude']}")
-
-            # Detect anomalies based on thresholds
-            anomalies = detect_anomalies(stats)
-            anomalies_detected = False
-            for channel, metrics in anomalies.items():
-                if metrics:
-                    anomalies_detected = True
-                    print(f"\nAnomalias en {channel}:")
-                    for metric, values in metrics.items():
-                        old_value, new_value = values
-                        print(f"  {metric}: Old = {old_value}, New = {new_value} (fuera del rango)")
-            
-            # Enviar estadsticas y diferencias al cliente
-            conn.sendall(f"Stats: {stats}\nDifferences: {differences}\n".encode())
-
-            # Enviar anomalas si se detectan
-            if anomalies_detected:
-                conn.sendall(f"Anomalies: {anomalies}\n".encode())
-
-            # Verify that the old file statistics match the new file statistics from the previous round
-            if previous_new_stats:
-                for channel_key, new_metrics in previous_new_stats.items():
-                    old_metrics = stats['Old File'][channel_key]
-                    for metric in new_metrics:
-                        if old_metrics[metric] != new_metrics[metric]:
-                            print(f"Anomaly detected in {metric} of {channel_key}: {old_metrics[metric]} != {new_metrics[metric]}")
-            
-            # Save the new file statistics for the next comparison
-            previous_new_stats = stats['New File']
-                        
-        except ValueError as e:
-            print(e)
-        
-        time.sleep(10)
+            while True:
+                msg_type, _payload = await isum_protocol.read_frame_async(reader)
+                if msg_type == isum_protocol.MSG_REQUEST_LATEST:
+                    self._put_drop_oldest(queue, self.latest or isum_protocol.encode_frame(isum_protocol.MSG_NO_RESULT))
+                elif msg_type == isum_protocol.MSG_SUBSCRIBE:
+                    self.subscribers.add(queue)
+                    if self.latest is not None:
+                        self._put_drop_oldest(queue, self.latest)
+                elif msg_type == isum_protocol.MSG_UNSUBSCRIBE:
+                    self.subscribers.discard(queue)
+                else:
+                    print(f'Trama desconocida de {addr}: tipo {msg_type}')
+        except (ConnectionError, isum_protocol.ProtocolError) as e:
+            print(f'Conexion con {addr} cerrada: {e}')
+        finally:
+            self.subscribers.discard(queue)
+            sender.cancel()
+            writer.close()
+
+def _init_analysis_worker():
+    # Ctrl+C is handled by the main process only
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metrics.collect()
+
+def _analyze_in_worker(counter, file_new, file_old):
+    """analyze_files plus the stage timings of the worker, which the parent exports."""
+    with metrics.timer('analysis'):
+        result = analyze_files(counter, file_new, file_old)
+    return result, metrics.drain()
+
+async def _analyze_and_publish(pool, result_server, counter, file_new, file_old):
+    loop = asyncio.get_running_loop()
+    try:
+        result, observations = await loop.run_in_executor(pool, _analyze_in_worker, counter, file_new, file_old)
+    except Exception as e:
+        print(f'Error en el analisis #{counter}: {e}')
+        metrics.count('analysis_error')
+        return
+    metrics.merge(observations)
+    if result is not None:
+        result_server.publish(result)
+
+async def acquisition_loop(result_server, directory='./tests_iot', period=CYCLE_PERIOD):
+    """
+    Producer: capture N+1 runs while capture N is analyzed in a worker process.
+
+    A new cycle starts every `period` seconds (or right away if the previous
+    one took longer). At most one analysis is in flight, and captures are
+    only archived once no analysis uses them.
+    """
+    loop = asyncio.get_running_loop()
+    watcher = CaptureWatcher(directory)
+    pending = None
+    counter = 0
+    # A single long-lived worker keeps its feature cache between cycles
+    with ProcessPoolExecutor(max_workers=1, initializer=_init_analysis_worker) as pool:
+        while True:
+            started = time.monotonic()
+            counter += 1
+            await loop.run_in_executor(None, run_command)
+            print(f'Test #{counter} done!!')
+            new_files = watcher.poll()
+
+            if pending is not None:
+                await pending
+                pending = None
+            await loop.run_in_executor(None, watcher.prune)  # Compressing into the archive takes a while
 
+            if new_files and len(watcher.files) >= 2:
+                pending = asyncio.create_task(
+                    _analyze_and_publish(pool, result_server, counter, watcher.files[-1], watcher.files[-2]))
 
+            await asyncio.sleep(max(0.0, period - (time.monotonic() - started)))
+
+async def serve(host='0.0.0.0', port=12345):
+    result_server = ResultServer(host, port)
+    await result_server.start()
+    await acquisition_loop(result_server)
+
+def start_server():
+    signal.signal(signal.SIGINT, signal_handler)
+    # Captures left by a previous run; any that cannot be archived yet stay and are retried by prune
+    archive_and_clean()
+    metrics.start_exporter(METRICS_PORT)
+    asyncio.run(serve())  # Escucha en todas las interfaces, puerto 12345
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the per-capture analysis of shmAnomali.
+
+Runs the analysis of every capture (statistics, spectral features, STFT
+transients) on synthetic memmapped captures, as the analysis worker does,
+and measures with tracemalloc:
+
+- peak_mb: memory allocated on top of the steady state during one cycle;
+- growth_kb: memory still held after the last cycle compared to the first.
+  numpy and scipy keep small caches that level off after a few hundred
+  cycles (a few hundred KB); a leak keeps growing with every cycle;
+- workspace_mb: preallocated buffers of the AnalysisWorkspace.
+
+Modes: 'stages' calls the stage functions one by one with fresh float64
+temporaries (the analysis before the workspace), 'workspace64' and
+'workspace32' reuse an AnalysisWorkspace in float64 / float32.
+
+    python3 benchmarks/bench_memory.py -n 50 --output bench_memory.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'IsumAndrasperry'))
+
+import shmAnomali
+
+from synthetic import write_captures
+
+def stage_features(data):
+    """The analysis as separate stages, every temporary allocated afresh."""
+    data = np.array(data)
+    signal_data = shmAnomali.analysis_signal(data)
+    energy, hop = shmAnomali.stft_band_energy(data)
+    return {
+        'stats': shmAnomali.compute_statistics(signal_data),
+        'spectral': shmAnomali.spectral_features(signal_data),
+        'transients': shmAnomali.detect_transients(energy, hop),
+    }
+
+def bench_mode(analyze, paths):
+    """tracemalloc peak per cycle and memory growth of `analyze` over the captures."""
+    analyze(shmAnomali.read_and_reshape(paths[0]))  # Warm up caches (windows, filters, FFT plans)
+    peaks, durations, held = [], [], []
+    tracemalloc.start()
+    for path in paths:
+        data = shmAnomali.read_and_reshape(path)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        features = analyze(data)
+        durations.append(time.perf_counter() - started)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        del features, data
+        held.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    peaks = np.asarray(peaks) / 1e6
+    return {
+        'cycles': len(paths),
+        'peak_mb_p50': float(np.median(peaks)),
+        'peak_mb_max': float(peaks.max()),
+        'growth_kb': (held[-1] - held[0]) / 1e3,
+        'cycle_ms_p50': float(np.median(durations) * 1e3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=30)
+    parser.add_argument('--output', default='bench_memory.json')
+    args = parser.parse_args()
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'iterations': args.iterations,
+        'modes': {},
+    }
+    modes = results['modes']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = write_captures(os.path.join(tmpdir, 'captures'), args.iterations)
+        modes['stages'] = bench_mode(stage_features, paths)
+        for name, dtype in (('workspace64', np.float64), ('workspace32', np.float32)):
+            workspace = shmAnomali.AnalysisWorkspace(dtype=dtype)
+            modes[name] = bench_mode(workspace.features, paths)
+            modes[name]['workspace_mb'] = workspace.nbytes / 1e6
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'mode':<14}{'peak MB p50':>12}{'peak MB max':>12}{'growth KB':>11}{'workspace MB':>14}{'ms/cycle':>10}")
+    for name, stats in modes.items():
+        print(f"{name:<14}{stats['peak_mb_p50']:>12.2f}{stats['peak_mb_max']:>12.2f}{stats['growth_kb']:>11.1f}"
+              f"{stats.get('workspace_mb', 0.0):>14.2f}{stats['cycle_ms_p50']:>10.2f}")
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
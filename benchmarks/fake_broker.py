@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Minimal local MQTT 3.1.1 broker, enough for the gateway publisher and the
+SQLite subscriber: CONNECT, PUBLISH (QoS 0 and 1), SUBSCRIBE with + and #
+wildcards, PINGREQ and DISCONNECT. Every received PUBLISH is recorded with its
+arrival time so the benchmark can measure end-to-end publish latency.
+"""
+
+import asyncio
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for idx, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if idx >= len(topic_parts) or (part != '+' and part != topic_parts[idx]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+def _packet(packet_type, body, flags=0):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([(packet_type << 4) | flags]) + bytes(encoded) + body
+
+class FakeBroker:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.received = []  # (arrival perf_counter, topic, payload)
+        self._subscriptions = {}  # writer -> [topic filters]
+        self._loop = None
+        self._server = None
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(_packet(CONNACK, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    arrival = time.perf_counter()
+                    qos = (flags >> 1) & 0x03
+                    (topic_len,) = struct.unpack_from('!H', body)
+                    topic = body[2:2 + topic_len].decode('utf-8')
+                    offset = 2 + topic_len
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(_packet(PUBACK, packet_id))
+                    payload = body[offset:]
+                    self.received.append((arrival, topic, payload))
+                    self._forward(topic, payload)
+                elif packet_type == SUBSCRIBE:
+                    packet_id = body[:2]
+                    offset, granted = 2, []
+                    while offset < len(body):
+                        (filter_len,) = struct.unpack_from('!H', body, offset)
+                        topic_filter = body[offset + 2:offset + 2 + filter_len].decode('utf-8')
+                        offset += 3 + filter_len
+                        self._subscriptions.setdefault(writer, []).append(topic_filter)
+                        granted.append(0)
+                    writer.write(_packet(SUBACK, packet_id + bytes(granted)))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, b''))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+    def _forward(self, topic, payload):
+        encoded_topic = topic.encode('utf-8')
+        packet = _packet(PUBLISH, struct.pack('!H', len(encoded_topic)) + encoded_topic + payload)
+        for writer, filters in self._subscriptions.items():
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                writer.write(packet)
+
+    def start(self):
+        """Run the broker in a background thread; returns the bound port."""
+        ready = threading.Event()
+
+        async def serve():
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            await self._server.serve_forever()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(serve())
+            except asyncio.CancelledError:
+                pass
+
+        threading.Thread(target=run, name='fake-broker', daemon=True).start()
+        ready.wait()
+        return self.port
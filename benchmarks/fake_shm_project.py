@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the ISUM ./shm_project executable. Accepts the same command line
+as shmAnomali.run_command and writes one synthetic capture into the -P folder.
+
+Symlink it as ./shm_project in the working directory of the server.
+"""
+
+import argparse
+import os
+import time
+
+from synthetic import write_capture
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-x', dest='xclbin')
+    parser.add_argument('-t', dest='test')
+    parser.add_argument('-b', dest='blocks')
+    parser.add_argument('-P', dest='path', default='tests_iot')
+    parser.add_argument('-C', dest='count')
+    parser.add_argument('--delay', type=float, default=float(os.environ.get('FAKE_SHM_DELAY', '0')),
+                        help='Simulated acquisition time in seconds')
+    parser.add_argument('--damage', type=float, default=float(os.environ.get('FAKE_SHM_DAMAGE', '0')))
+    args = parser.parse_args()
+
+    if args.delay:
+        time.sleep(args.delay)
+    os.makedirs(args.path, exist_ok=True)
+    stamp = time.time_ns()
+    write_capture(os.path.join(args.path, f'isum_{stamp}.bin'), seed=stamp % (2 ** 32), damage=args.damage)
+    print(f'Capture written to {args.path}')
+
+if __name__ == '__main__':
+    main()
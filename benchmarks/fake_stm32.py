@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pty-based stand-in for the STM32 LoRa node. The gateway opens the slave side
+as its serial port; the fake node drives the handshake on the master side:
+
+    node -> 0xAA
+    gateway -> [number, letter, position] + XOR checksum
+    node -> ACK (0x06, 0x00) or NACK (0x15, 0x00) if the checksum is wrong
+"""
+
+import os
+import select
+import time
+import tty
+import pty
+
+ACK = bytes([0x06, 0x00])
+NACK = bytes([0x15, 0x00])
+
+class FakeSTM32:
+
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+
+    def _read_exactly(self, size, timeout):
+        data = b''
+        deadline = time.monotonic() + timeout
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.master], [], [], remaining)[0]:
+                raise TimeoutError(f'Gateway sent {len(data)} of {size} bytes')
+            data += os.read(self.master, size - len(data))
+        return data
+
+    def handshake(self, timeout=5.0):
+        """Run one handshake; returns (round_trip_seconds, payload, checksum_ok)."""
+        started = time.perf_counter()
+        os.write(self.master, b'\xAA')
+        reply = self._read_exactly(4, timeout)
+        elapsed = time.perf_counter() - started
+        payload, checksum = reply[:3], reply[3]
+        expected = 0
+        for byte in payload:
+            expected ^= byte
+        ok = expected == checksum
+        os.write(self.master, ACK if ok else NACK)
+        return elapsed, payload, ok
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the ISUM pipeline without the real hardware.
+
+Runs every stage against local stand-ins (fake shm_project, pty STM32, local
+MQTT broker, temporary SQLite file) and reports latency percentiles and
+throughput per stage. Results are also written as JSON so runs can be compared:
+
+    python3 benchmarks/run_benchmarks.py -n 50 --output bench_results.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+for subdir in ('mqtt_subAndSqlite', 'mqtt_clientAndUART', 'IsumAndrasperry'):
+    sys.path.insert(0, os.path.join(REPO_DIR, subdir))
+
+import shmAnomali
+import shm_comunication
+import RaspUartAndTCp
+from mqtt_send import MQTTClient
+import isum_db
+
+from synthetic import write_captures
+from fake_stm32 import FakeSTM32
+from fake_broker import FakeBroker
+
+def summarize(samples, elapsed=None, items=None):
+    """Latency percentiles in milliseconds and throughput in operations per second."""
+    samples = np.asarray(samples, dtype=np.float64)
+    elapsed = samples.sum() if elapsed is None else elapsed
+    items = len(samples) if items is None else items
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1e3
+    return {
+        'count': int(len(samples)),
+        'mean_ms': float(samples.mean() * 1e3),
+        'p50_ms': float(p50),
+        'p90_ms': float(p90),
+        'p99_ms': float(p99),
+        'max_ms': float(samples.max() * 1e3),
+        'throughput_per_s': float(items / elapsed) if elapsed > 0 else None,
+    }
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+def bench_capture(workdir, n):
+    """./shm_project subprocess plus the capture write (fake executable)."""
+    link = os.path.join(workdir, 'shm_project')
+    if not os.path.exists(link):
+        os.symlink(os.path.join(BENCH_DIR, 'fake_shm_project.py'), link)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shmAnomali.clean_directory()
+        return summarize([timed(shmAnomali.run_command) for _ in range(n)])
+    finally:
+        os.chdir(cwd)
+
+def bench_stats(paths):
+    """Statistics of all channels of a freshly mapped capture (no cache)."""
+    return summarize([timed(shmAnomali.compute_statistics, shmAnomali.read_and_reshape(path)) for path in paths])
+
+def bench_fft(paths):
+    """Spectral features of all channels of a freshly mapped capture (no cache)."""
+    return summarize([timed(shmAnomali.spectral_features, shmAnomali.read_and_reshape(path)) for path in paths])
+
+def start_result_server(capture_dir):
+    """ResultServer on loopback in a background event loop, with one result published."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='result-server', daemon=True).start()
+    server = shmAnomali.ResultServer('127.0.0.1', 0)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    server.port = server.server.sockets[0].getsockname()[1]
+    result = shmAnomali.analyze_cycle(1, capture_dir)
+    loop.call_soon_threadsafe(server.publish, result)
+    return server
+
+def bench_tcp_fetch(server, n):
+    """Request/response of the latest result over the persistent connection."""
+    shm_comunication.fetch_isum_data('127.0.0.1', server.port)  # Connect once
+    return summarize([timed(shm_comunication.fetch_isum_data, '127.0.0.1', server.port) for _ in range(n)])
+
+def bench_uart(server, broker_port, n):
+    """0xAA -> payload + checksum round trip against RaspUartAndTCp.main over a pty."""
+    RaspUartAndTCp.ISUM_HOST = '127.0.0.1'
+    RaspUartAndTCp.ISUM_PORT = server.port
+    RaspUartAndTCp.MQTT_BROKER = '127.0.0.1'
+    RaspUartAndTCp.MQTT_PORT = broker_port
+    node = FakeSTM32()
+    threading.Thread(target=RaspUartAndTCp.main, kwargs={'ports': [node.port]}, name='gateway', daemon=True).start()
+    time.sleep(1.0)  # Let the prefetcher receive the first result
+
+    samples, errors = [], 0
+    for _ in range(n):
+        elapsed, _payload, ok = node.handshake()
+        samples.append(elapsed)
+        errors += not ok
+        time.sleep(0.15)
+    stats = summarize(samples)
+    stats['checksum_errors'] = errors
+    return stats
+
+def bench_publish(broker, n):
+    """MQTTClient.publish() call to arrival at the broker (persistent client)."""
+    client = MQTTClient('127.0.0.1', broker.port, 'bench', 'bench', qos=1)
+    client.start()
+    topic = 'bench/publish'
+    sent = {}
+    enqueue = []
+    for seq in range(n):
+        started = time.perf_counter()
+        client.publish(topic, {'seq': seq, 'Alert': 0, 'position_letter': 'A', 'position_number': seq % 100})
+        enqueue.append(time.perf_counter() - started)
+        sent[seq] = started
+        time.sleep(0.002)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and sum(1 for _, t, _ in broker.received if t == topic) < n:
+        time.sleep(0.01)
+    latencies = [arrival - sent[json.loads(payload)['seq']]
+                 for arrival, t, payload in broker.received if t == topic]
+    client.stop()
+    stats = summarize(latencies) if latencies else {'count': 0}
+    stats['lost'] = n - len(latencies)
+    stats['enqueue'] = summarize(enqueue)
+    return stats
+
+def bench_db(tmpdir, rows, batch=100):
+    """Batched inserts into the messages table, then the BatchWriter throughput."""
+    payload = json.dumps({'Alert': 0, 'position_letter': 'A', 'position_number': 1, 'Anomalies': None})
+    conn = isum_db.connect(os.path.join(tmpdir, 'bench_direct.db'))
+    isum_db.init_db(conn)
+    batches = [[('bench/db', payload, isum_db.utc_timestamp())] * batch for _ in range(max(1, rows // batch))]
+    samples = [timed(isum_db.insert_messages, conn, rows_batch) for rows_batch in batches]
+    conn.close()
+    stats = summarize(samples, items=batch * len(batches))
+    stats['batch_size'] = batch
+
+    writer = isum_db.BatchWriter(os.path.join(tmpdir, 'bench_writer.db'))
+    writer.start()
+    writer.wait_ready()
+    started = time.perf_counter()
+    for _ in range(rows):
+        writer.submit('bench/db', payload)
+    writer.stop()
+    stats['writer_rows_per_s'] = writer.rows_written / (time.perf_counter() - started)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=30)
+    parser.add_argument('--db-rows', type=int, default=20000)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the components')
+    args = parser.parse_args()
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'iterations': args.iterations,
+        'stages': {},
+    }
+    stages = results['stages']
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    with tempfile.TemporaryDirectory() as tmpdir, quiet:
+        paths = write_captures(os.path.join(tmpdir, 'captures'), args.iterations)
+        stages['capture'] = bench_capture(tmpdir, args.iterations)
+        stages['stats'] = bench_stats(paths)
+        stages['fft'] = bench_fft(paths)
+
+        broker = FakeBroker()
+        broker.start()
+        server = start_result_server(os.path.join(tmpdir, 'captures'))
+        stages['tcp_fetch'] = bench_tcp_fetch(server, args.iterations)
+        stages['uart_roundtrip'] = bench_uart(server, broker.port, args.iterations)
+        stages['publish'] = bench_publish(broker, args.iterations)
+        stages['db_insert'] = bench_db(tmpdir, args.db_rows)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'stage':<16}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'ops/s':>12}")
+    for name, stats in stages.items():
+        if not stats.get('count'):
+            print(f'{name:<16} no samples')
+            continue
+        print(f"{name:<16}{stats['p50_ms']:>10.3f}{stats['p90_ms']:>10.3f}{stats['p99_ms']:>10.3f}"
+              f"{stats['max_ms']:>10.3f}{stats['throughput_per_s']:>12.1f}")
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic ISUM captures in the format read by shmAnomali.read_and_reshape:
+8 channels x 16384 samples of int16, channel-major.
+"""
+
+import os
+import numpy as np
+
+CHANNELS = 8
+SAMPLES = 16384
+FS = 1000  # Hz, as in matlabCode/shm.m
+
+def make_capture(seed=0, damage=0.0, channels=CHANNELS, samples=SAMPLES, fs=FS):
+    """
+    Return an (channels, samples) int16 capture: a few structural modes per
+    channel plus noise. `damage` in [0, 1] lowers the mode frequencies and
+    damps them, as a crude stand-in for a damaged structure.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(samples) / fs
+    modes = np.array([12.0, 37.0, 81.0, 143.0]) * (1.0 - 0.15 * damage)
+    data = np.empty((channels, samples))
+    for ch in range(channels):
+        amplitudes = rng.uniform(300, 1500, len(modes)) * (1.0 - 0.5 * damage)
+        phases = rng.uniform(0, 2 * np.pi, len(modes))
+        signal = (amplitudes[:, None] * np.sin(2 * np.pi * modes[:, None] * t + phases[:, None])).sum(axis=0)
+        data[ch] = signal + rng.normal(0, 200, samples)
+    return np.clip(data, -32768, 32767).astype(np.int16)
+
+def write_capture(path, seed=0, damage=0.0):
+    """Write a synthetic capture to `path` and return the path."""
+    make_capture(seed, damage).tofile(path)
+    return path
+
+def write_captures(directory, count, prefix='capture', damage=0.0, start_seed=0):
+    """Write `count` captures with increasing names and seeds; returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    return [write_capture(os.path.join(directory, f'{prefix}_{idx:06d}.bin'), start_seed + idx, damage)
+            for idx in range(count)]
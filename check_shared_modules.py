@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the modules shared between the ISUM programs are still identical.
+
+Every folder is deployed on its own device, so the shared modules are copied
+into each of them instead of imported from one place: the programs only import
+modules of their own folder, never from a sibling one. Run this after editing
+any copy and before deploying (exit status 1 if a copy differs); --sync copies
+the given folder's version over the others.
+
+    python3 check_shared_modules.py
+    python3 check_shared_modules.py --sync mqtt_clientAndUART
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SHARED_MODULES = {
+    'metrics.py': ('IsumAndrasperry', 'mqtt_clientAndUART', 'mqtt_subAndSqlite'),
+    'isum_protocol.py': ('IsumAndrasperry', 'mqtt_clientAndUART'),
+    'telemetry_codec.py': ('mqtt_clientAndUART', 'mqtt_subAndSqlite'),
+    'isum_db.py': ('mqtt_subAndSqlite', 'IsumAndrasperry'),
+}
+
+def read(folder, module):
+    """Contents of a copy, or None if the folder has no copy yet."""
+    try:
+        with open(os.path.join(REPO_DIR, folder, module), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def differing(module, folders):
+    """Folders whose copy of `module` differs from the first folder's."""
+    reference = read(folders[0], module)
+    return [folder for folder in folders[1:] if read(folder, module) != reference]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sync', metavar='FOLDER', help='Copy the shared modules of FOLDER over the other copies')
+    args = parser.parse_args()
+
+    failed = False
+    for module, folders in SHARED_MODULES.items():
+        if args.sync in folders:
+            for folder in folders:
+                if folder != args.sync:
+                    shutil.copyfile(os.path.join(REPO_DIR, args.sync, module), os.path.join(REPO_DIR, folder, module))
+            print(f'{module}: copiado de {args.sync} a {", ".join(f for f in folders if f != args.sync)}')
+            continue
+        stale = differing(module, folders)
+        if stale:
+            failed = True
+            print(f'{module}: {", ".join(stale)} difiere de {folders[0]}')
+        else:
+            print(f'{module}: {len(folders)} copias identicas')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
-#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import serial
+import socket
 import time
 import random
 from mqtt_send import MQTTClient
 import threading
 import shm_comunication
+import metrics
 
 def calculate_checksum(data):
     """Calcula el checksum XOR de una secuencia de bytes."""
@@ -16,11 +17,43 @@ def calculate_checksum(data):
         checksum ^= byte
     return checksum
 
+# Servidor ISUM y antiguedad maxima (s) de un resultado para usarlo en el handshake
+ISUM_HOST = "192.168.10.91"
+ISUM_PORT = 12345
+MAX_RESULT_AGE = 60
+
+# Codigo enviado al nodo (y como "Alert" por MQTT)
+RESULT_OK = 0
+RESULT_ANOMALY = 1
+RESULT_UNKNOWN = 2  # Sin resultado reciente del ISUM: el estado es desconocido
+
+# Broker MQTT
+MQTT_BROKER = "192.168.100.23"
+MQTT_PORT = 1883
+MQTT_USERNAME = "lywsz"
+MQTT_PASSWORD = "992258"
+# "binary" (telemetry_codec, a few hundred bytes) or "json" (legacy, several KB)
+MQTT_ENCODING = "binary"
+# Los deltas del formato binario necesitan cada mensaje: QoS 1 para que el broker no los pierda
+MQTT_QOS = 1 if MQTT_ENCODING == "binary" else 0
+# Cada pasarela publica en su propio subtopico (el codec binario lleva estado por topico)
+GATEWAY_ID = socket.gethostname()
+MQTT_TOPIC = f"test/topic/{GATEWAY_ID}"
+
+# Puertos serie, uno por nodo STM32 LoRa
+SERIAL_PORTS = ['/dev/ttyS0']
+BAUDRATE = 115200
+SERIAL_RETRY_DELAY = 5  # Segundos antes de reabrir un puerto que fallo
+
+# Handshake
+ACK = 0x06
+NACK = 0x15
+MAX_RETRIES = 3  # Retransmisiones tras un NACK
+
+# /metrics endpoint cuando ISUM_METRICS esta definida
+METRICS_PORT = 9102
+
 def data_mqtt(data , shm_data):
-    broker = "192.168.100.23"
-    port = 1883
-    username = "lywsz"
-    password = "992258"
     
     Alerta = data[0]
     Letter = chr(data[1])
@@ -32,81 +65,159 @@ def data_mqtt(data , shm_data):
        "position_number": number
     }
     
-    client = MQTTClient(broker, port, username, password)
-    client.connect()
+    # One long-lived connection per broker; publish() only enqueues the message
+    client = MQTTClient.get_shared(MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+                                   qos=MQTT_QOS, encoding=MQTT_ENCODING)
     data2 = {"key": "value", "temperature": 20}
     final_data = new_data | data2 | shm_data
     
-    client.publish("test/topic", final_data)
-    client.disconnect()
+    client.publish(MQTT_TOPIC, final_data)
     
 
     
 
-def main():
-    # Ajusta el puerto y la velocidad (baud rate) 
-    # : /dev/ttyS0 a 115200
-    ser = serial.Serial('/dev/ttyS0', 115200, timeout=1)
+class NodeHandshake(threading.Thread):
+    """
+    Handshake state machine of one STM32 node on its own serial port.
 
-    print("Handshake with STM32: We wait for 0xAA and then send a number. Ctrl+C to exit.")
-    
+    WAIT_REQUEST: wait for 0xAA
+    WAIT_ACK: the answer was sent, wait for ACK (0x06) or NACK (0x15); a NACK
+              retransmits the same answer up to MAX_RETRIES times
+    Every node has its own thread, so a slow or silent node never delays the
+    others; all of them share the ISUM prefetcher and the MQTT connection.
+    """
 
-    try:
-        while True:
-            # 1) Esperar la seal 0xAA del STM32
+    WAIT_REQUEST = 'WAIT_REQUEST'
+    WAIT_ACK = 'WAIT_ACK'
+
+    def __init__(self, port, baudrate, prefetcher, stop_event):
+        super().__init__(name=f'uart-{port}', daemon=True)
+        self.port = port
+        self.baudrate = baudrate
+        self.prefetcher = prefetcher
+        self.stop_event = stop_event
+        self.state = self.WAIT_REQUEST
+        self.handshakes = 0
+
+    def log(self, text):
+        print(f"[{self.port}] {text}")
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                with serial.Serial(self.port, self.baudrate, timeout=1) as ser:
+                    self.log("Handshake with STM32: We wait for 0xAA and then send a number.")
+                    self.serve(ser)
+            except serial.SerialException as e:
+                # Puerto desconectado: se vuelve a abrir pasado un tiempo
+                self.log(f"Error en el puerto serie: {e}")
+                metrics.count('uart_error')
+                self.stop_event.wait(SERIAL_RETRY_DELAY)
+        self.log("Closing serial port.")
+
+    def serve(self, ser):
+        while not self.stop_event.is_set():
+            # 1) Esperar la senal 0xAA del STM32 (timeout de 1s para revisar stop_event)
+            self.state = self.WAIT_REQUEST
             byte_in = ser.read(1)
-            if len(byte_in) == 1:
-                if byte_in[0] == 0xAA:
-                    # El STM32 pide un numero
-                    host = "192.168.10.91"
-                    port = 12345
-                    shm_data = shm_comunication.fetch_isum_data(host, port)
-                    
-                    if shm_data['Anomalies']:
-                        print(" Anomalies detected!")
-                        number = 1
-                    else:
-                        print(" No anomalies detected.")
-                        number = 0
-                   
-                    #number = random.randint(1, 100) & 0xFF
-                    position_letter = 0x41 + (random.randint(0, 25))
-                    position_number = random.randint(0, 100) & 0xFF
-                    
-                    message = bytes([number, position_letter, position_number])
-                    
-                    checksum = calculate_checksum(message)
-                    message_with_checksum = message + bytes([checksum])
-                    
-                    
-                    ser.write(message_with_checksum)
-                    print(f"Enviado: {number} {chr(position_letter)} {position_number} Checksum: {checksum:02X}")
-                    data_mqtt(message,shm_data)
-
-                   
-                    resp = ser.read(2)
-                    if len(resp) == 2 and resp[0]==0x06:
-                        print("Confirmacion recibida: ACK (0x06)")
-                        time.sleep(0.1)
-
-                    elif len(resp) == 2 and resp[0]==0x06:
-                        print("Confirmacion recibida: NACK (0x15), retransmitiendo...")
-                        time.sleep(0.1)
-                else:
-                    # Recibi un byte que no es 0xAA (puede que sea basura o debug)
-                    print(f"Recibi un byte inesperado: 0x{byte_in[0]:02X}")
-                    time.sleep(0.1)
-            else:
-                # Timeout de 1s, no llego nada
+            if len(byte_in) != 1:
+                continue
+            if byte_in[0] != 0xAA:
+                # Recibi un byte que no es 0xAA (puede que sea basura o debug)
+                self.log(f"Recibi un byte inesperado: 0x{byte_in[0]:02X}")
+                continue
+            while self.handshake(ser):
                 pass
 
-            time.sleep(0.5)
+    def answer(self):
+        """Answer [number, letter, position] and the ISUM result it is based on."""
+        # El STM32 pide un numero: se responde con el resultado en memoria
+        shm_data = self.prefetcher.latest(MAX_RESULT_AGE)
+        if shm_data is None:
+            self.log("No recent ISUM result, reporting unknown state.")
+            metrics.count('stale_result')
+            shm_data = {}
+            number = RESULT_UNKNOWN
+        elif shm_data['Anomalies']:
+            self.log("Anomalies detected!")
+            number = RESULT_ANOMALY
+        else:
+            self.log("No anomalies detected.")
+            number = RESULT_OK
+
+        position_letter = 0x41 + (random.randint(0, 25))
+        position_number = random.randint(0, 100) & 0xFF
+        return bytes([number, position_letter, position_number]), shm_data
+
+    def handshake(self, ser):
+        """Answer one 0xAA request and publish the answer; returns True if the node sent a new 0xAA instead of confirming."""
+        handshake_started = time.perf_counter()
+        message, shm_data = self.answer()
+        checksum = calculate_checksum(message)
+        frame = message + bytes([checksum])
+
+        new_request = False
+        for attempt in range(MAX_RETRIES + 1):
+            ser.write(frame)
+            self.log(f"Enviado: {message[0]} {chr(message[1])} {message[2]} Checksum: {checksum:02X}")
+            self.state = self.WAIT_ACK
+            with metrics.timer('uart_wait'):
+                # Un byte: si es un 0xAA no se consume nada de la peticion siguiente
+                resp = ser.read(1)
+                if resp and resp[0] in (ACK, NACK):
+                    resp += ser.read(1)  # Byte final (0x00) de la confirmacion
+            if resp[:1] == bytes([ACK]):
+                self.log("Confirmacion recibida: ACK (0x06)")
+                metrics.observe('handshake', time.perf_counter() - handshake_started)
+                self.handshakes += 1
+                break
+            if resp[:1] == bytes([NACK]):
+                metrics.count('uart_nack')
+                if attempt < MAX_RETRIES:
+                    self.log(f"Confirmacion recibida: NACK (0x15), retransmitiendo ({attempt + 1}/{MAX_RETRIES})...")
+                    continue
+                self.log(f"NACK tras {MAX_RETRIES} reintentos, se descarta la respuesta")
+            elif resp == b'\xAA':
+                # El nodo reinicio el handshake sin confirmar: se atiende la nueva peticion
+                self.log("Nueva peticion 0xAA sin confirmacion previa")
+                metrics.count('uart_no_ack')
+                new_request = True
+            else:
+                self.log(f"Sin confirmacion del STM32 (recibido {resp.hex() or 'nada'})")
+                metrics.count('uart_no_ack')
+            metrics.count('uart_failed')
+            break
 
+        # Publicacion MQTT fuera del camino del handshake (solo se encola), tambien sin confirmacion
+        data_mqtt(message, shm_data)
+        return new_request
+
+def main(ports=None, baudrate=BAUDRATE):
+    """Serve every serial port in `ports` (default SERIAL_PORTS) at the same time."""
+    ports = list(ports or SERIAL_PORTS)
+
+    # Mantiene en memoria el ultimo resultado del ISUM, compartido por todos los nodos
+    # Un enlace sin resultados durante MAX_RESULT_AGE se da por muerto y se reabre
+    prefetcher = shm_comunication.ISUMPrefetcher(ISUM_HOST, ISUM_PORT, read_timeout=MAX_RESULT_AGE)
+    prefetcher.start()
+    metrics.start_exporter(METRICS_PORT)
+
+    stop_event = threading.Event()
+    nodes = [NodeHandshake(port, baudrate, prefetcher, stop_event) for port in ports]
+    for node in nodes:
+        node.start()
+    print(f"Gateway serving {len(nodes)} node(s): {', '.join(ports)}. Ctrl+C to exit.")
+
+    try:
+        while any(node.is_alive() for node in nodes):
+            time.sleep(1)
     except KeyboardInterrupt:
         pass
     finally:
-        ser.close()
-        print("Closing serial port.")
+        stop_event.set()
+        for node in nodes:
+            node.join(2)
+        MQTTClient.close_all()
 
 if __name__ == '__main__':
     main()
@@ -3,18 +3,85 @@
 
 import paho.mqtt.client as mqtt
 import json
+import queue
+import threading
+import metrics
+import telemetry_codec
+
+_STOP = object()  # Queued by stop(): the sender ends after the messages queued before it
 
 class MQTTClient:
-    def __init__(self, broker, port, username, password):
-        
+    # Long-lived clients shared per broker (see get_shared)
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    def __init__(self, broker, port, username, password, queue_size=1000, qos=0, encoding='json'):
+
         self.broker = broker
         self.port = port
         self.username = username
         self.password = password
+        self.queue_size = queue_size
+        self.qos = qos
+        # 'json' or 'binary' (telemetry_codec) for dict messages
+        if encoding not in ('json', 'binary'):
+            raise ValueError(f"Unknown encoding: {encoding}")
+        self.encoding = encoding
+        self._encoders = {}  # topic -> TelemetryEncoder, deltas are per topic
+        self._encoders_lock = threading.Lock()
+        self._reset_encoders = threading.Event()  # Set on (re)connect, handled by the encoding thread
+
+        # Send queue and worker, only used in persistent mode (see start)
+        self.queue = None
+        self._sender = None
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
 
         # Create the MQTT client
         self.client = mqtt.Client()
         self.client.username_pw_set(self.username, self.password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+    @classmethod
+    def get_shared(cls, broker, port, username, password, **kwargs):
+        """
+        Return the persistent client for this broker, starting it on first use.
+        """
+        key = (broker, port, username)
+        with cls._pool_lock:
+            client = cls._pool.get(key)
+            if client is None:
+                client = cls(broker, port, username, password, **kwargs)
+                client.start()
+                cls._pool[key] = client
+        return client
+
+    @classmethod
+    def close_all(cls, timeout=5):
+        """
+        Flush and stop every shared client.
+        """
+        with cls._pool_lock:
+            clients = list(cls._pool.values())
+            cls._pool.clear()
+        for client in clients:
+            client.stop(timeout)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            # The subscriber may have missed messages: restart the deltas with a keyframe.
+            # The encoders belong to the sender thread, which resets them before its next message.
+            self._reset_encoders.set()
+            self._connected.set()
+            print(f"Connected to the MQTT broker in {self.broker}:{self.port}")
+        else:
+            print(f"Error connecting to MQTT broker, code: {rc}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        if rc != 0:
+            print(f"Connection to MQTT broker lost ({rc}), reconnecting...")
 
     def connect(self):
         """
@@ -26,22 +93,106 @@ class MQTTClient:
         except Exception as e:
             print(f"Error connecting to MQTT broker: {e}")
 
-    def publish(self, topic, message):
-        
+    def start(self, min_delay=1, max_delay=60):
+        """
+        Persistent mode: keep one connection open with the network loop running,
+        reconnect with exponential backoff and send queued messages in the background.
+        """
+        if self._sender is not None:
+            return
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.client.reconnect_delay_set(min_delay, max_delay)
+        # connect_async lets loop_start keep retrying if the broker is down at startup
+        self.client.connect_async(self.broker, self.port)
+        self.client.loop_start()
+        self._sender = threading.Thread(target=self._send_loop, name="mqtt-sender", daemon=True)
+        self._sender.start()
+
+    def _send_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP or self._stopping.is_set():
+                break
+            topic, message = item
+            # Hold the message until the connection is (re)established
+            while not self._connected.wait(1):
+                if self._stopping.is_set():
+                    return
+            self._publish_now(topic, message)
+
+    def _publish_now(self, topic, message):
         try:
-            if isinstance(message,dict):
-               message = json.dumps(message)
-            
-            result = self.client.publish(topic, message)
+            with metrics.timer('mqtt_publish'):
+                if isinstance(message,dict):
+                   message = self._encode(topic, message)
+
+                result = self.client.publish(topic, message, qos=self.qos)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"Message posted to the topic '{topic}': {message}")
+                if isinstance(message, bytes):
+                    print(f"Message posted to the topic '{topic}': {len(message)} bytes ({self.encoding})")
+                else:
+                    print(f"Message posted to the topic '{topic}': {message}")
             else:
                 print(f"Error al enviar el mensaje: {result.rc}")
         except Exception as e:
             print(f"Error sending message: {e}")
 
+    def _encode(self, topic, message):
+        if self.encoding == 'json':
+            return json.dumps(message)
+        # Encoded in the sender thread, so messages dropped from the queue never break the delta chain
+        with self._encoders_lock:
+            if self._reset_encoders.is_set():
+                self._reset_encoders.clear()
+                for encoder in self._encoders.values():
+                    encoder.reset()
+            encoder = self._encoders.get(topic)
+            if encoder is None:
+                encoder = self._encoders[topic] = telemetry_codec.TelemetryEncoder()
+            return encoder.encode(message)
+
+    def publish(self, topic, message):
+        """
+        Publish a message. In persistent mode it is only enqueued and the call
+        returns immediately; if the queue is full the oldest message is dropped.
+        """
+        if self._sender is None:
+            self._publish_now(topic, message)
+            return
+        self._enqueue((topic, message))
+
+    def _enqueue(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    metrics.count('mqtt_dropped')
+                    print("MQTT send queue full, dropping oldest message")
+                except queue.Empty:
+                    pass
+
+    def stop(self, timeout=5):
+        """
+        Send what is left in the queue and close the persistent connection.
+        """
+        sender = self._sender
+        if sender is None:
+            return
+        self._enqueue(_STOP)
+        sender.join(timeout)
+        # Give up on messages that could not be sent in time; the queue is kept
+        # because the sender may still be finishing a message
+        self._stopping.set()
+        sender.join(1)
+        self._sender = None
+        self.disconnect()
+        self.client.loop_stop()
+
     def disconnect(self):
-        
+
         self.client.disconnect()
         print("Disconnected from the MQTT broker")
 
@@ -56,4 +207,4 @@ if __name__ == "__main__":
      data  = {"key": "value", "temperature": 22.5}
      client.publish("test/topic", data)
      client.disconnect()
-    
+
@@ -1,70 +1,125 @@
-
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import socket
-import ast
-
-def fetch_isum_data(host: str, port: int, buffer_size: int = 4096) -> dict:
-    
-
-    # Diccionario donde guardamos lo que llegue del servidor
-    result = {
-        'Stats': None,
-        'Differences': None,
-        'Anomalies': None
-    }
-
-    # 1) Crear socket y conectar
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((host, port))
-
-    # 2) Recibir datos hasta que el servidor cierre la conexion
-    data_buffer = ""
-    while True:
-        chunk = client_socket.recv(buffer_size)
-        if not chunk:
-            # Si no hay mas datos, el servidor cerro la conexion
-            break
-        data_buffer += chunk.decode()
-
-    client_socket.close()
-
-   
-    lines = data_buffer.split('\n')
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue 
-
-        # Verificamos que tipo de mensaje es
-        if line.startswith("Stats:"):
-            dict_str = line[len("Stats:"):].strip()  # extraemos el texto
-            try:
-                result['Stats'] = ast.literal_eval(dict_str)
-            except:
-                result['Stats'] = None  # Si falla el parseo
-
-        elif line.startswith("Differences:"):
-            dict_str = line[len("Differences:"):].strip()
+import threading
+import time
+import isum_protocol
+import metrics
+
+# Conexiones persistentes al servidor ISUM, una por (host, port)
+_connections = {}
+
+def _get_connection(host, port, timeout):
+    sock = _connections.get((host, port))
+    if sock is None:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        _connections[(host, port)] = sock
+    sock.settimeout(timeout)
+    return sock
+
+def close_connection(host, port):
+    sock = _connections.pop((host, port), None)
+    if sock is not None:
+        sock.close()
+
+def fetch_isum_data(host: str, port: int, timeout: float = 30.0) -> dict:
+    """
+    Ask the ISUM server for its latest analysis result and read exactly one frame.
+
+    The connection is kept open between calls; on any error it is closed so the
+    next call reconnects.
+    """
+    try:
+        with metrics.timer('tcp_fetch'):
+            sock = _get_connection(host, port, timeout)
+            sock.sendall(isum_protocol.encode_frame(isum_protocol.MSG_REQUEST_LATEST))
+            msg_type, payload = isum_protocol.read_frame(sock)
+    except (OSError, isum_protocol.ProtocolError):
+        close_connection(host, port)
+        raise
+
+    if msg_type == isum_protocol.MSG_RESULT:
+        return isum_protocol.result_to_dict(isum_protocol.decode_payload(payload))
+    if msg_type != isum_protocol.MSG_NO_RESULT:
+        print(f"[INFO] Trama desconocida recibida: tipo {msg_type}")
+    # El servidor aun no tiene resultados
+    return {'Stats': None, 'Differences': None, 'Anomalies': None}
+
+def iter_isum_results(host: str, port: int, timeout: float = None):
+    """
+    Subscribe to the ISUM server and yield every new analysis result as it arrives.
+
+    Uses its own connection, separate from fetch_isum_data(). With a timeout, a
+    link that stays silent for that long raises socket.timeout instead of
+    blocking forever; TCP keepalive also detects a dead peer.
+    """
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.sendall(isum_protocol.encode_frame(isum_protocol.MSG_SUBSCRIBE))
+        while True:
+            msg_type, payload = isum_protocol.read_frame(sock)
+            if msg_type == isum_protocol.MSG_RESULT:
+                with metrics.timer('result_decode'):
+                    result = isum_protocol.result_to_dict(isum_protocol.decode_payload(payload))
+                yield result
+
+class ISUMPrefetcher(threading.Thread):
+    """
+    Background subscriber that keeps the latest ISUM result in memory, so the
+    UART handshake can answer without any network round trip.
+
+    If no result arrives for read_timeout seconds the connection is assumed
+    dead and reopened.
+    """
+
+    def __init__(self, host, port, retry_delay=5.0, read_timeout=None):
+        super().__init__(name='isum-prefetch', daemon=True)
+        self.host = host
+        self.port = port
+        self.retry_delay = retry_delay
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._latest = None
+        self._received = None  # time.monotonic() of the latest result
+
+    def run(self):
+        while True:
             try:
-                result['Differences'] = ast.literal_eval(dict_str)
-            except:
-                result['Differences'] = None
-
-        elif line.startswith("Anomalies:"):
-            dict_str = line[len("Anomalies:"):].strip()
-            try:
-                result['Anomalies'] = ast.literal_eval(dict_str)
-            except:
-                result['Anomalies'] = None
-
-        else:
-            # Si llega otra linea no reconocida, la imprimimos o la ignoramos
-            print(f"[INFO] Linea desconocida recibida: {line}")
-
-    return result
+                for result in iter_isum_results(self.host, self.port, self.read_timeout):
+                    with self._lock:
+                        # The server replays its latest result on every subscription:
+                        # a replay must not make an old result look fresh again
+                        if self._latest is not None and result['Timestamp'] == self._latest['Timestamp']:
+                            continue
+                        self._latest = result
+                        self._received = time.monotonic()
+                    # Fetch latency of the real path: from the server building the result
+                    # to the gateway holding it (both clocks must be NTP synchronized)
+                    metrics.observe('result_delivery', max(0.0, time.time() - result['Timestamp']))
+            except socket.timeout:
+                print(f"[INFO] Sin resultados del servidor ISUM en {self.read_timeout}s, reconectando...")
+                metrics.count('isum_timeout')
+            except (OSError, isum_protocol.ProtocolError) as e:
+                print(f"[INFO] Conexion con el servidor ISUM perdida ({e}), reintentando...")
+            time.sleep(self.retry_delay)
+
+    def latest(self, max_age=None):
+        """
+        Latest result, or None if there is none or it is older than max_age seconds.
+
+        The age is the larger of the time since the gateway received the result and
+        the time since the server built it (its Timestamp): the result the server
+        replays on a new subscription, e.g. after a gateway restart, may be old.
+        """
+        with self._lock:
+            if self._latest is None:
+                return None
+            if max_age is not None:
+                age = max(time.monotonic() - self._received, time.time() - self._latest['Timestamp'])
+                if age > max_age:
+                    return None
+            return self._latest
 
 def main():
     # Ajusta estos valores a la IP y puerto de tu servidor
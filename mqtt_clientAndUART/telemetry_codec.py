@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact binary encoding of the ISUM telemetry messages published over MQTT.
+
+MQTT 3.1.1 has no content-type property, so the format is marked in band: a
+binary message starts with MAGIC (0xB5) while a legacy JSON message always
+starts with '{'. A binary message is a fixed header (magic, version, flags,
+sequence number, alert, position letter and number) followed by tagged
+sections:
+
+- Stats tables (New File, Old File, Differences) as float32 per channel and
+  metric. Against the last message sent on the topic a table may instead be a
+  delta (bitmap of changed values + those values), "Old File = previous New
+  File" or "Differences = New - Old", which cost zero or a few bytes.
+- Anomalies as a (channel, metric) bitmap; the (old, new) pairs are rebuilt
+  from the stats tables.
+- Spectral arrays as float32, Classification, Counter and Timestamp.
+- Any other key as compact JSON.
+
+Deltas need the previous message, so the encoder sends a keyframe (no deltas)
+every KEYFRAME_INTERVAL messages and after reset(). After a gap in the
+sequence numbers the decoder still returns the self-contained sections (full
+tables, anomaly flags, spectral, classification, counter, extra) and leaves
+out the tables that refer to the lost message until the next keyframe.
+
+Encoder and decoder state is per stream: publish every sender (gateway) on
+its own topic.
+
+This file is shared verbatim by mqtt_clientAndUART/ and mqtt_subAndSqlite/;
+check_shared_modules.py verifies the copies.
+"""
+
+import json
+import struct
+from array import array
+
+MAGIC = 0xB5
+VERSION = 2  # 2: delta tables carry their channel count
+KEYFRAME_INTERVAL = 20
+
+STAT_METRICS = ('Mean', 'Median', 'Std Dev', 'Variance')
+SPECTRAL_KEYS = ('Bands', 'Band Energy', 'Band Energy Ratio', 'Peak Frequency', 'Centroid')
+CLASSIFICATION_KEYS = ('Score A', 'Score B', 'Margin')
+
+HEADER = struct.Struct('<BBBHBcB')  # magic, version, flags, sequence, alert, letter, number
+FLAG_KEYFRAME = 0x01
+FLAG_POSITION = 0x02  # Alert / position_letter / position_number are present
+
+# Sections
+TAG_STATS_NEW = 1
+TAG_STATS_OLD = 2
+TAG_DIFFERENCES = 3
+TAG_ANOMALIES = 4
+TAG_SPECTRAL = 5
+TAG_CLASSIFICATION = 6
+TAG_COUNTER = 7
+TAG_EXTRA = 15
+
+TABLE_TAGS = ((TAG_STATS_NEW, 'New File'), (TAG_STATS_OLD, 'Old File'))
+
+# Encoding modes of a stats table
+MODE_FULL = 0
+MODE_DELTA = 1
+MODE_PREVIOUS_NEW = 2  # Old File equals the New File of the previous message
+MODE_DERIVED = 3       # Differences equal New File - Old File
+MODE_NONE = 4
+
+_MISSING = object()  # Table whose reference message was not received
+
+class CodecError(ValueError):
+    """Raised when a binary message is malformed."""
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] == MAGIC
+
+def _float32(values):
+    """Round values to float32, as they will be seen by the decoder."""
+    return array('f', values).tolist()
+
+def _table_values(table):
+    """{'Channel N': {metric: v}} -> flat float32 list in channel, STAT_METRICS order, or None."""
+    if not isinstance(table, dict) or not table:
+        return None
+    values = []
+    for idx in range(len(table)):
+        row = table.get(f'Channel {idx + 1}')
+        if not isinstance(row, dict) or tuple(row) != STAT_METRICS:
+            return None
+        values.extend(row.values())
+    try:
+        return _float32(values)
+    except TypeError:
+        return None
+
+def _values_table(values):
+    n = len(STAT_METRICS)
+    return {
+        f'Channel {idx + 1}': dict(zip(STAT_METRICS, values[idx * n:(idx + 1) * n]))
+        for idx in range(len(values) // n)
+    }
+
+def _table_value(values, index):
+    return None if values is _MISSING or values is None else values[index]
+
+def _bitmap(bits):
+    out = bytearray((len(bits) + 7) // 8)
+    for idx, bit in enumerate(bits):
+        if bit:
+            out[idx >> 3] |= 1 << (idx & 7)
+    return bytes(out)
+
+def _bits(data, count):
+    return [bool(data[idx >> 3] & (1 << (idx & 7))) for idx in range(count)]
+
+def _shape(value):
+    """Shape of a rectangular nested list of numbers, or None."""
+    if isinstance(value, (list, tuple)):
+        shapes = {_shape(item) for item in value}
+        if len(shapes) > 1 or None in shapes:
+            return None
+        return (len(value),) + (shapes.pop() if shapes else ())
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return ()
+    return None
+
+def _flatten(value, out):
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _flatten(item, out)
+    else:
+        out.append(value)
+    return out
+
+def _unflatten(values, shape):
+    if not shape:
+        return values[0]
+    if len(shape) == 1:
+        return list(values)
+    step = len(values) // shape[0]
+    return [_unflatten(values[idx * step:(idx + 1) * step], shape[1:]) for idx in range(shape[0])]
+
+class TelemetryEncoder:
+    """Stateful encoder for one topic (deltas refer to the previous message)."""
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the previous message; the next one is a keyframe."""
+        self._previous = {}
+        self._since_keyframe = None
+
+    def _encode_table(self, tag, values, reference, keyframe):
+        if values is None:
+            return struct.pack('<BB', tag, MODE_NONE)
+        full = struct.pack('<BBB', tag, MODE_FULL, len(values) // len(STAT_METRICS)) + array('f', values).tobytes()
+        if keyframe or reference is None or len(reference) != len(values):
+            return full
+        changed = [new != old for new, old in zip(values, reference)]
+        delta = (struct.pack('<BBB', tag, MODE_DELTA, len(values) // len(STAT_METRICS)) + _bitmap(changed) +
+                 array('f', [v for v, c in zip(values, changed) if c]).tobytes())
+        return delta if len(delta) < len(full) else full
+
+    def encode(self, message):
+        """Encode a telemetry dict; returns bytes."""
+        message = dict(message)
+        keyframe = self._since_keyframe is None or self._since_keyframe + 1 >= self.keyframe_interval
+        if keyframe:
+            self._previous = {}
+            self._since_keyframe = 0
+        else:
+            self._since_keyframe += 1
+        self.sequence = (self.sequence + 1) & 0xFFFF
+
+        flags = FLAG_KEYFRAME if keyframe else 0
+        alert, letter, number = 0, b'\0', 0
+        position = (message.get('Alert'), message.get('position_letter'), message.get('position_number'))
+        if (isinstance(position[0], int) and 0 <= position[0] <= 255 and
+                isinstance(position[1], str) and len(position[1]) == 1 and position[1].isascii() and
+                isinstance(position[2], int) and 0 <= position[2] <= 255):
+            flags |= FLAG_POSITION
+            alert, letter, number = position[0], position[1].encode('ascii'), position[2]
+            for key in ('Alert', 'position_letter', 'position_number'):
+                del message[key]
+        parts = [HEADER.pack(MAGIC, VERSION, flags, self.sequence, alert, letter, number)]
+        sent = {}
+
+        stats = message.get('Stats')
+        if isinstance(stats, dict) and set(stats) == {'New File', 'Old File'}:
+            new = _table_values(stats['New File'])
+            old = _table_values(stats['Old File'])
+            if (new is None) == (stats['New File'] is None) and (old is None) == (stats['Old File'] is None):
+                del message['Stats']
+                parts.append(self._encode_table(TAG_STATS_NEW, new, self._previous.get(TAG_STATS_NEW), keyframe))
+                previous_new = self._previous.get(TAG_STATS_NEW)
+                if not keyframe and old is not None and old == previous_new:
+                    parts.append(struct.pack('<BB', TAG_STATS_OLD, MODE_PREVIOUS_NEW))
+                else:
+                    parts.append(self._encode_table(TAG_STATS_OLD, old, self._previous.get(TAG_STATS_OLD), keyframe))
+                sent[TAG_STATS_NEW], sent[TAG_STATS_OLD] = new, old
+
+                if 'Differences' in message:
+                    differences = _table_values(message['Differences'])
+                    if differences is not None or message['Differences'] is None:
+                        del message['Differences']
+                        if (differences is not None and new is not None and old is not None and
+                                differences == _float32([n - o for n, o in zip(new, old)])):
+                            parts.append(struct.pack('<BB', TAG_DIFFERENCES, MODE_DERIVED))
+                        else:
+                            parts.append(self._encode_table(TAG_DIFFERENCES, differences,
+                                                            self._previous.get(TAG_DIFFERENCES), keyframe))
+                        sent[TAG_DIFFERENCES] = differences
+
+                anomalies = message.get('Anomalies', ())
+                if anomalies is None:
+                    del message['Anomalies']
+                    parts.append(struct.pack('<BB', TAG_ANOMALIES, 0))
+                elif isinstance(anomalies, dict) and new is not None and old is not None:
+                    channels = len(new) // len(STAT_METRICS)
+                    flags_ = [metric in (anomalies.get(f'Channel {idx + 1}') or {})
+                              for idx in range(channels) for metric in STAT_METRICS]
+                    if sum(flags_) == sum(len(v) for v in anomalies.values()):
+                        del message['Anomalies']
+                        parts.append(struct.pack('<BB', TAG_ANOMALIES, channels) + _bitmap(flags_))
+
+        spectral = message.get('Spectral')
+        if isinstance(spectral, dict) and set(spectral) <= set(SPECTRAL_KEYS):
+            arrays = []
+            for key, value in spectral.items():
+                shape = _shape(value)
+                if shape is None or len(shape) > 255:
+                    break
+                arrays.append(struct.pack('<BB%dH' % len(shape), SPECTRAL_KEYS.index(key), len(shape), *shape) +
+                              array('f', _flatten(value, [])).tobytes())
+            else:
+                del message['Spectral']
+                parts.append(struct.pack('<BB', TAG_SPECTRAL, len(arrays)) + b''.join(arrays))
+
+        classification = message.get('Classification')
+        if (isinstance(classification, dict) and set(classification) == {'Class'} | set(CLASSIFICATION_KEYS)
+                and isinstance(classification['Class'], str) and len(classification['Class']) == 1
+                and all(isinstance(classification[key], (int, float)) for key in CLASSIFICATION_KEYS)):
+            del message['Classification']
+            parts.append(struct.pack('<Bc3f', TAG_CLASSIFICATION, classification['Class'].encode('ascii'),
+                                     *(classification[key] for key in CLASSIFICATION_KEYS)))
+
+        if isinstance(message.get('Counter'), int) and isinstance(message.get('Timestamp'), (int, float)):
+            parts.append(struct.pack('<BId', TAG_COUNTER, message.pop('Counter') & 0xFFFFFFFF,
+                                     message.pop('Timestamp')))
+
+        if message:
+            extra = json.dumps(message, separators=(',', ':')).encode('utf-8')
+            parts.append(struct.pack('<BI', TAG_EXTRA, len(extra)) + extra)
+
+        self._previous = sent
+        return b''.join(parts)
+
+class TelemetryDecoder:
+    """Stateful decoder for one topic, the counterpart of TelemetryEncoder."""
+
+    def __init__(self):
+        self._previous = None  # Tables of the last decoded message, None until the first message
+        self._sequence = None
+        self.partial = False  # The last message had sections that refer to a lost message
+        self.duplicate = False  # The last message was a redelivery of the one before (QoS 1)
+        self.gaps = 0  # Sequence gaps seen
+        self._last_payload = None
+        self._last_message = None
+
+    def _read_table(self, payload, offset, reference):
+        mode = payload[offset]
+        offset += 1
+        if mode == MODE_NONE:
+            return None, offset
+        if mode == MODE_FULL:
+            count = payload[offset] * len(STAT_METRICS)
+            offset += 1
+            return array('f', payload[offset:offset + 4 * count]).tolist(), offset + 4 * count
+        if mode == MODE_DELTA:
+            count = payload[offset] * len(STAT_METRICS)
+            offset += 1
+            size = (count + 7) // 8
+            changed = _bits(payload[offset:offset + size], count)
+            offset += size
+            size = 4 * sum(changed)
+            if reference is None or len(reference) != count:
+                return _MISSING, offset + size
+            values = iter(array('f', payload[offset:offset + size]).tolist())
+            return [next(values) if c else old for old, c in zip(reference, changed)], offset + size
+        raise CodecError(f'unknown table mode {mode}')
+
+    def decode(self, payload):
+        """Decode a binary message into the same dict the JSON format carries.
+
+        A redelivered copy of the previous message (same sequence number and
+        bytes) returns the previous decode and sets `duplicate`; the delta
+        state is left untouched.
+        """
+        payload = bytes(payload)
+        self.duplicate = payload == self._last_payload
+        if self.duplicate:
+            return dict(self._last_message)
+        self._last_payload = None
+        try:
+            message = self._decode(payload)
+        except (struct.error, IndexError, StopIteration, UnicodeError, json.JSONDecodeError) as e:
+            self._previous = None
+            raise CodecError(f'malformed telemetry message: {e}') from e
+        self._last_payload, self._last_message = payload, message
+        return dict(message)
+
+    def _decode(self, payload):
+        magic, version, flags, sequence, alert, letter, number = HEADER.unpack_from(payload)
+        if magic != MAGIC or version != VERSION:
+            raise CodecError(f'not a telemetry message (magic 0x{magic:02X}, version {version})')
+        if flags & FLAG_KEYFRAME:
+            self._previous = {}
+        elif self._previous is None or sequence != (self._sequence + 1) & 0xFFFF:
+            # A message was lost: the tables that refer to it are left out until the next keyframe
+            if self._previous is not None:
+                self.gaps += 1
+            self._previous = {}
+        self._sequence = sequence
+
+        message = {}
+        if flags & FLAG_POSITION:
+            message.update(Alert=alert, position_letter=letter.decode('ascii'), position_number=number)
+        tables = {}
+        offset = HEADER.size
+        while offset < len(payload):
+            tag = payload[offset]
+            offset += 1
+            if tag in (TAG_STATS_NEW, TAG_STATS_OLD):
+                if payload[offset] == MODE_PREVIOUS_NEW:
+                    previous_new = self._previous.get(TAG_STATS_NEW)
+                    tables[tag] = _MISSING if previous_new is None else previous_new
+                    offset += 1
+                else:
+                    tables[tag], offset = self._read_table(payload, offset, self._previous.get(tag))
+                if TAG_STATS_NEW in tables and TAG_STATS_OLD in tables:
+                    stats = {
+                        name: None if tables[table_tag] is None else _values_table(tables[table_tag])
+                        for table_tag, name in TABLE_TAGS if tables[table_tag] is not _MISSING
+                    }
+                    if stats:
+                        message['Stats'] = stats
+            elif tag == TAG_DIFFERENCES:
+                if payload[offset] == MODE_DERIVED:
+                    new, old = tables.get(TAG_STATS_NEW, _MISSING), tables.get(TAG_STATS_OLD, _MISSING)
+                    if new is _MISSING or old is _MISSING:
+                        values = _MISSING
+                    else:
+                        values = _float32([n - o for n, o in zip(new, old)])
+                    offset += 1
+                else:
+                    values, offset = self._read_table(payload, offset, self._previous.get(tag))
+                tables[tag] = values
+                if values is not _MISSING:
+                    message['Differences'] = None if values is None else _values_table(values)
+            elif tag == TAG_ANOMALIES:
+                channels = payload[offset]
+                offset += 1
+                if not channels:
+                    message['Anomalies'] = None
+                    continue
+                size = (channels * len(STAT_METRICS) + 7) // 8
+                flagged = _bits(payload[offset:offset + size], channels * len(STAT_METRICS))
+                offset += size
+                # The flags are self-contained; the (old, new) values of a missing table are None
+                new, old = tables.get(TAG_STATS_NEW, _MISSING), tables.get(TAG_STATS_OLD, _MISSING)
+                anomalies = {}
+                for idx in range(channels):
+                    row = {
+                        metric: (_table_value(old, idx * len(STAT_METRICS) + m),
+                                 _table_value(new, idx * len(STAT_METRICS) + m))
+                        for m, metric in enumerate(STAT_METRICS) if flagged[idx * len(STAT_METRICS) + m]
+                    }
+                    if row:
+                        anomalies[f'Channel {idx + 1}'] = row
+                message['Anomalies'] = anomalies or None
+            elif tag == TAG_SPECTRAL:
+                spectral = {}
+                count = payload[offset]
+                offset += 1
+                for _ in range(count):
+                    key, ndim = payload[offset], payload[offset + 1]
+                    shape = struct.unpack_from('<%dH' % ndim, payload, offset + 2)
+                    offset += 2 + 2 * ndim
+                    size = 1
+                    for dim in shape:
+                        size *= dim
+                    values = array('f', payload[offset:offset + 4 * size]).tolist()
+                    offset += 4 * size
+                    spectral[SPECTRAL_KEYS[key]] = _unflatten(values, shape)
+                message['Spectral'] = spectral
+            elif tag == TAG_CLASSIFICATION:
+                cls, *scores = struct.unpack_from('<c3f', payload, offset)
+                offset += struct.calcsize('<c3f')
+                message['Classification'] = {'Class': cls.decode('ascii'), **dict(zip(CLASSIFICATION_KEYS, scores))}
+            elif tag == TAG_COUNTER:
+                message['Counter'], message['Timestamp'] = struct.unpack_from('<Id', payload, offset)
+                offset += struct.calcsize('<Id')
+            elif tag == TAG_EXTRA:
+                (length,) = struct.unpack_from('<I', payload, offset)
+                offset += 4
+                message.update(json.loads(payload[offset:offset + length].decode('utf-8')))
+                offset += length
+            else:
+                raise CodecError(f'unknown section {tag}')
+
+        self.partial = any(values is _MISSING for values in tables.values())
+        self._previous = {tag: values for tag, values in tables.items() if values is not _MISSING}
+        return message
+
+def decode_message(payload, decoder):
+    """
+    Decode a binary or legacy JSON payload into a dict.
+    Returns (message, format) with format 'binary' or 'json'.
+    """
+    if is_binary(payload):
+        return decoder.decode(payload), 'binary'
+    return json.loads(payload.decode('utf-8') if isinstance(payload, (bytes, bytearray)) else payload), 'json'
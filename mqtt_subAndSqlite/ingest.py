@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ingestion pool of the MQTT subscriber.
+
+The paho callback only calls IngestPool.submit(topic, payload), which puts
+the raw bytes on a bounded queue; worker threads decode, validate and write
+them. Messages are sharded by topic, so the messages of one topic are always
+handled in order by the same worker (the binary telemetry format is delta
+encoded per topic).
+
+When a shard's queue is full the policy decides:
+- 'block': wait for room, up to block_timeout seconds, then drop. This holds
+  back paho's network thread and so the broker connection;
+- 'drop': drop the oldest queued message;
+- 'spill': append to a spill file on disk. While a shard has spilled
+  messages new ones are spilled too, and its worker replays the file once the
+  queue is empty, so the per-topic order is kept. Spill files left by a crash
+  are replayed at start.
+
+Every outcome is counted (stats() and the metrics module).
+"""
+
+import glob
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+
+POLICIES = ('block', 'drop', 'spill')
+
+SPILL_RECORD = struct.Struct('<dHI')  # received time, topic length, payload length
+
+class _Shard:
+
+    def __init__(self, index, queue_size, spill_dir):
+        self.index = index
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.spill_path = os.path.join(spill_dir, f'spill-{index}.bin') if spill_dir else None
+        self.spill_file = None
+        self.spilled = 0  # Records in the current spill file
+        self.spilling = False  # True from the first spilled message until the spill is fully replayed
+
+    def spill(self, item):
+        """Append to the spill file (caller holds the lock)."""
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, 'ab')
+        self.spilling = True
+        topic, payload, received = item
+        topic = topic.encode('utf-8')
+        self.spill_file.write(SPILL_RECORD.pack(received, len(topic), len(payload)) + topic + payload)
+        self.spilled += 1
+
+    def take_spill(self):
+        """Detach the spill file for replay; returns its path, or None (and stops spilling) if it is empty."""
+        with self.lock:
+            if not self.spilled:
+                self.spilling = False
+                return None
+            self.spill_file.close()
+            self.spill_file = None
+            self.spilled = 0
+            draining = self.spill_path + '.draining'
+            os.replace(self.spill_path, draining)
+            return draining
+
+def read_spill(path):
+    """Yield the (topic, payload, received) records of a spill file."""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(SPILL_RECORD.size)
+            if len(header) < SPILL_RECORD.size:
+                return
+            received, topic_len, payload_len = SPILL_RECORD.unpack(header)
+            topic = f.read(topic_len)
+            payload = f.read(payload_len)
+            if len(payload) < payload_len:
+                return  # Truncated by a crash
+            yield topic.decode('utf-8'), payload, received
+
+class IngestPool:
+
+    def __init__(self, handler, workers=4, queue_size=10000, policy='block', spill_dir='spill', block_timeout=30.0):
+        """
+        handler(topic, payload, received, state): processes one message in a
+            worker thread; `state` is a dict private to the worker (e.g. decoders)
+        queue_size: total queued messages, split between the workers
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, expected one of {POLICIES}")
+        self.handler = handler
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill_dir = spill_dir if policy == 'spill' else None
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.shards = [_Shard(idx, max(1, queue_size // workers), self.spill_dir) for idx in range(workers)]
+        self.counters = dict.fromkeys(('received', 'processed', 'errors', 'dropped', 'spilled', 'replayed'), 0)
+        self.blocked_seconds = 0.0
+        self._counters_lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def _count(self, name, value=1):
+        with self._counters_lock:
+            self.counters[name] += value
+        metrics.count(f'ingest_{name}', value)
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['blocked_seconds'] = self.blocked_seconds
+        stats['queued'] = sum(shard.queue.qsize() for shard in self.shards)
+        return stats
+
+    def submit(self, topic, payload):
+        """Queue one raw message according to the policy; called from the MQTT network thread."""
+        item = (topic, bytes(payload), time.time())
+        shard = self.shards[zlib.crc32(topic.encode('utf-8')) % len(self.shards)]
+        self._count('received')
+        if self.policy == 'spill':
+            with shard.lock:
+                if not shard.spilling:
+                    try:
+                        shard.queue.put_nowait(item)
+                        return
+                    except queue.Full:
+                        pass
+                shard.spill(item)
+            self._count('spilled')
+        elif self.policy == 'drop':
+            while True:
+                try:
+                    shard.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        shard.queue.get_nowait()
+                        self._count('dropped')
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                shard.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            started = time.perf_counter()
+            try:
+                shard.queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                self._count('dropped')
+            finally:
+                waited = time.perf_counter() - started
+                self.blocked_seconds += waited
+                metrics.observe('ingest_block', waited)
+
+    def _handle(self, item, state):
+        topic, payload, received = item
+        metrics.observe('ingest_queue_wait', max(0.0, time.time() - received))
+        try:
+            self.handler(topic, payload, received, state)
+            self._count('processed')
+        except Exception as e:
+            self._count('errors')
+            print(f"Error procesando un mensaje de {topic}: {e}")
+
+    def _worker(self, shard):
+        state = {}
+        while True:
+            try:
+                item = shard.queue.get(timeout=0.2)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self._handle(item, state)
+                continue
+            if shard.spill_path:
+                draining = shard.take_spill()
+                if draining is not None:
+                    for record in read_spill(draining):
+                        self._handle(record, state)
+                        self._count('replayed')
+                    os.remove(draining)
+                    continue
+            if self._stopping.is_set():
+                return
+
+    def _recover_spills(self):
+        """Replay the spill files left by a previous run before any new message."""
+        # Oldest first: an interrupted recovery, then a file being replayed, then the one being written
+        age = {'.recover': 0, '.draining': 1}
+        leftovers = sorted(glob.glob(os.path.join(self.spill_dir, 'spill-*.bin*')),
+                           key=lambda path: (age.get(os.path.splitext(path)[1], 2), path))
+        for path in leftovers:
+            recovered = path + '.recover'
+            os.replace(path, recovered)
+            count = 0
+            for topic, payload, received in read_spill(recovered):
+                shard = self.shards[zlib.crc32(topic.encode('utf-8')) % len(self.shards)]
+                with shard.lock:
+                    shard.spill((topic, payload, received))
+                count += 1
+            os.remove(recovered)
+            print(f"Recuperados {count} mensajes del volcado {path}")
+
+    def start(self):
+        if self.spill_dir:
+            self._recover_spills()
+        for shard in self.shards:
+            thread = threading.Thread(target=self._worker, args=(shard,), name=f'ingest-{shard.index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Process what is queued (and spilled), then stop the workers."""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite message store of the ISUM results (Isum.db): raw payloads, typed
+columns, per-channel statistics and hourly/daily rollups.
+
+This file is shared verbatim by mqtt_subAndSqlite/ (sub2_mqtt.py) and
+IsumAndrasperry/ (replay.py); check_shared_modules.py verifies the copies.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+import metrics
+
+DB_PATH = 'Isum.db'
+
+def utc_timestamp(seconds=None):
+    """Timestamp (now, or `seconds` since the epoch) in the same format as SQLite CURRENT_TIMESTAMP."""
+    moment = datetime.now(timezone.utc) if seconds is None else datetime.fromtimestamp(seconds, timezone.utc)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def connect(db_path=DB_PATH):
+    """Open a connection tuned for a single long-lived writer."""
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only syncs at checkpoints and is still crash safe
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+STAT_COLUMNS = {'Mean': 'mean', 'Median': 'median', 'Std Dev': 'std_dev', 'Variance': 'variance'}
+
+# Typed columns shredded from the JSON payload, added to older databases on start
+MESSAGE_COLUMNS = {
+    'alert': 'INTEGER',
+    'position_letter': 'TEXT',
+    'position_number': 'INTEGER',
+    'anomaly_count': 'INTEGER',
+    'class': 'TEXT',
+}
+
+ROLLUPS = {'hourly': 'rollup_hourly', 'daily': 'rollup_daily'}
+
+def init_db(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+    for column, column_type in MESSAGE_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE messages ADD COLUMN {column} {column_type}')
+
+    flag_columns = ''.join(f'anomaly_{column} INTEGER NOT NULL DEFAULT 0, ' for column in STAT_COLUMNS.values())
+    stat_columns = ''.join(f'{column} REAL, ' for column in STAT_COLUMNS.values())
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS channel_stats (
+            message_id INTEGER NOT NULL,
+            channel INTEGER NOT NULL,
+            {stat_columns}{flag_columns}
+            PRIMARY KEY (message_id, channel)
+        ) WITHOUT ROWID
+    ''')
+    for table in ROLLUPS.values():
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                position_letter TEXT NOT NULL,
+                position_number INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                alerts INTEGER NOT NULL,
+                anomalies INTEGER NOT NULL,
+                damaged INTEGER NOT NULL,
+                max_std_dev REAL,
+                PRIMARY KEY (bucket, position_letter, position_number)
+            ) WITHOUT ROWID
+        ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_position '
+                 'ON messages (position_letter, position_number, timestamp)')
+    conn.commit()
+
+SQLITE_INT_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+def _as_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if SQLITE_INT_RANGE[0] <= value <= SQLITE_INT_RANGE[1] else None
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _as_text(value):
+    return value if isinstance(value, str) else None
+
+def _as_dict(value):
+    return value if isinstance(value, dict) else {}
+
+def shred(data):
+    """
+    Typed fields of a decoded payload: (message columns, [(channel, stats, flags)]).
+    Unknown, missing or malformed fields are left as NULL; malformed sections are skipped.
+    """
+    if not isinstance(data, dict):
+        return dict.fromkeys(MESSAGE_COLUMNS), []
+    anomalies = data.get('Anomalies') or {}
+    stats = _as_dict(_as_dict(data.get('Stats')).get('New File'))
+    classification = _as_dict(data.get('Classification'))
+    columns = {
+        'alert': _as_int(data.get('Alert')),
+        'position_letter': _as_text(data.get('position_letter')),
+        'position_number': _as_int(data.get('position_number')),
+        'anomaly_count': (sum(len(flags) for flags in anomalies.values() if isinstance(flags, dict))
+                          if isinstance(anomalies, dict) else None),
+        'class': _as_text(classification.get('Class')),
+    }
+    anomalies = _as_dict(anomalies)
+    channels = []
+    for channel_name, values in stats.items():
+        channel = _as_int(str(channel_name).rsplit(' ', 1)[-1])
+        if channel is None or not isinstance(values, dict):
+            continue
+        flagged = _as_dict(anomalies.get(channel_name))
+        channels.append((channel,
+                         [_as_float(values.get(metric)) for metric in STAT_COLUMNS],
+                         [int(metric in flagged) for metric in STAT_COLUMNS]))
+    return columns, channels
+
+def _rollup_rows(rows):
+    """Aggregate shredded rows per (hour, position) and (day, position)."""
+    buckets = {'hourly': {}, 'daily': {}}
+    for timestamp, columns, channels in rows:
+        # Rollup keys cannot be NULL (NULLs never conflict), messages without a position go to ('', -1)
+        number = columns['position_number']
+        position = (columns['position_letter'] or '', -1 if number is None else number)
+        std_devs = [stats[2] for _, stats, _ in channels if stats[2] is not None]
+        for granularity, bucket in (('hourly', timestamp[:13] + ':00:00'), ('daily', timestamp[:10])):
+            agg = buckets[granularity].setdefault((bucket,) + position, [0, 0, 0, 0, None])
+            agg[0] += 1
+            agg[1] += columns['alert'] == 1  # 2 = unknown (no recent ISUM result), not an alert
+            agg[2] += bool(columns['anomaly_count'])
+            agg[3] += columns['class'] == 'B'
+            if std_devs:
+                agg[4] = max(std_devs) if agg[4] is None else max(agg[4], max(std_devs))
+    return buckets
+
+def insert_messages(conn, rows):
+    """
+    Insert (topic, payload, timestamp[, data]) rows in a single transaction,
+    with their typed columns, per-channel statistics and rollup updates.
+    `data` is the already decoded payload; it is parsed here if missing.
+    """
+    with conn:
+        add_messages(conn, rows)
+
+def add_messages(conn, rows):
+    """Like insert_messages, but inside the caller's transaction (nothing is committed)."""
+    shredded = []
+    message_rows = []
+    for row in rows:
+        topic, payload, timestamp = row[:3]
+        data = row[3] if len(row) > 3 else None
+        if data is None:
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = None
+        columns, channels = shred(data)
+        shredded.append((timestamp, columns, channels))
+        message_rows.append((topic, payload, timestamp) + tuple(columns[c] for c in MESSAGE_COLUMNS))
+
+    names = ', '.join(MESSAGE_COLUMNS)
+    marks = ', '.join('?' * len(MESSAGE_COLUMNS))
+    conn.executemany(f'INSERT INTO messages (topic, payload, timestamp, {names}) VALUES (?, ?, ?, {marks})',
+                     message_rows)
+    # A single writer inside one transaction gets consecutive ids ending at last_insert_rowid()
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    first_id = last_id - len(message_rows) + 1
+    channel_rows = [
+        (first_id + idx, channel, *stats, *flags)
+        for idx, (_, _, channels) in enumerate(shredded)
+        for channel, stats, flags in channels
+    ]
+    if channel_rows:
+        stat_names = ', '.join(STAT_COLUMNS.values())
+        flag_names = ', '.join(f'anomaly_{column}' for column in STAT_COLUMNS.values())
+        conn.executemany(f'INSERT INTO channel_stats (message_id, channel, {stat_names}, {flag_names}) '
+                         f'VALUES (?, ?, {", ".join("?" * 2 * len(STAT_COLUMNS))})', channel_rows)
+
+    for granularity, buckets in _rollup_rows(shredded).items():
+        conn.executemany(f'''
+            INSERT INTO {ROLLUPS[granularity]}
+                (bucket, position_letter, position_number, messages, alerts, anomalies, damaged, max_std_dev)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (bucket, position_letter, position_number) DO UPDATE SET
+                messages = messages + excluded.messages,
+                alerts = alerts + excluded.alerts,
+                anomalies = anomalies + excluded.anomalies,
+                damaged = damaged + excluded.damaged,
+                max_std_dev = MAX(COALESCE(max_std_dev, excluded.max_std_dev),
+                                  COALESCE(excluded.max_std_dev, max_std_dev))
+        ''', [key + tuple(agg) for key, agg in buckets.items()])
+
+def delete_messages(conn, topic, since=None, until=None):
+    """
+    Delete the messages of `topic` stored in [since, until) with their channel
+    statistics and take them out of the rollups, inside the caller's transaction.
+
+    Rollup counters are decremented exactly; max_std_dev of a touched bucket is
+    recomputed from the messages still stored. Returns the number of deleted messages.
+    """
+    where = ' WHERE topic = ?'
+    params = [topic]
+    if since is not None:
+        where += ' AND timestamp >= ?'
+        params.append(since)
+    if until is not None:
+        where += ' AND timestamp < ?'
+        params.append(until)
+    names = ', '.join(MESSAGE_COLUMNS)
+    deleted = [(timestamp, dict(zip(MESSAGE_COLUMNS, values)), [])
+               for timestamp, *values in conn.execute(f'SELECT timestamp, {names} FROM messages{where}', params)]
+    if not deleted:
+        return 0
+    conn.execute(f'DELETE FROM channel_stats WHERE message_id IN (SELECT id FROM messages{where})', params)
+    conn.execute(f'DELETE FROM messages{where}', params)
+
+    for granularity, buckets in _rollup_rows(deleted).items():
+        table = ROLLUPS[granularity]
+        width = 13 if granularity == 'hourly' else 10  # Length of the bucket prefix of a timestamp
+        for key, agg in buckets.items():
+            conn.execute(f'''
+                UPDATE {table} SET messages = messages - ?, alerts = alerts - ?, anomalies = anomalies - ?,
+                    damaged = damaged - ?
+                WHERE bucket = ? AND position_letter = ? AND position_number = ?
+            ''', tuple(agg[:4]) + key)
+            bucket, letter, number = key
+            conn.execute(f'''
+                UPDATE {table} SET max_std_dev = (
+                    SELECT MAX(channel_stats.std_dev) FROM messages JOIN channel_stats ON channel_stats.message_id = messages.id
+                    WHERE substr(messages.timestamp, 1, ?) = substr(?, 1, ?)
+                      AND COALESCE(messages.position_letter, '') = ? AND COALESCE(messages.position_number, -1) = ?)
+                WHERE bucket = ? AND position_letter = ? AND position_number = ?
+            ''', (width, bucket, width, letter, number) + key)
+        conn.execute(f'DELETE FROM {table} WHERE messages <= 0')
+    return len(deleted)
+
+def prune(conn, keep_days=30, keep_hourly_days=90):
+    """Retention: delete raw messages older than keep_days and hourly rollups older than keep_hourly_days.
+
+    Daily rollups are kept forever.
+    """
+    with conn:
+        cutoff = conn.execute("SELECT datetime('now', ?)", (f'-{keep_days} days',)).fetchone()[0]
+        conn.execute('DELETE FROM channel_stats WHERE message_id IN '
+                     '(SELECT id FROM messages WHERE timestamp < ?)', (cutoff,))
+        deleted = conn.execute('DELETE FROM messages WHERE timestamp < ?', (cutoff,)).rowcount
+        conn.execute("DELETE FROM rollup_hourly WHERE bucket < datetime('now', ?)", (f'-{keep_hourly_days} days',))
+    return deleted
+
+def query_rollup(conn, granularity='hourly', position_letter=None, position_number=None, since=None, until=None):
+    """Rollup rows for the dashboards, oldest bucket first, optionally for one position and time range."""
+    query = f'SELECT * FROM {ROLLUPS[granularity]} WHERE 1 = 1'
+    params = []
+    if position_letter is not None:
+        query += ' AND position_letter = ?'
+        params.append(position_letter)
+    if position_number is not None:
+        query += ' AND position_number = ?'
+        params.append(position_number)
+    if since is not None:
+        query += ' AND bucket >= ?'
+        params.append(since)
+    if until is not None:
+        query += ' AND bucket < ?'
+        params.append(until)
+    query += ' ORDER BY bucket'
+    return _fetch_dicts(conn, query, params)
+
+def query_anomalies(conn, position_letter, position_number, since=None, until=None):
+    """Raw messages with anomalies at one position, newest first (uses idx_messages_position)."""
+    query = ('SELECT id, topic, timestamp, alert, anomaly_count, class FROM messages '
+             'WHERE position_letter = ? AND position_number = ? AND anomaly_count > 0')
+    params = [position_letter, position_number]
+    if since is not None:
+        query += ' AND timestamp >= ?'
+        params.append(since)
+    if until is not None:
+        query += ' AND timestamp < ?'
+        params.append(until)
+    query += ' ORDER BY timestamp DESC'
+    return _fetch_dicts(conn, query, params)
+
+def _fetch_dicts(conn, query, params):
+    cursor = conn.execute(query, params)
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+class BatchWriter(threading.Thread):
+    """
+    Dedicated SQLite writer. Messages are queued with submit() and written with
+    executemany in one transaction when batch_size rows are pending or
+    flush_interval seconds have passed since the first pending row.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=500, flush_interval=1.0, queue_size=10000,
+                 keep_days=30, prune_interval=3600):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.keep_days = keep_days
+        self.prune_interval = prune_interval
+        self.rows_written = 0
+        self._ready = threading.Event()
+
+    def submit(self, topic, payload, timestamp=None, data=None):
+        """Queue a message for writing; `data` is the decoded payload if the caller already has it.
+
+        Blocks only if the writer is far behind.
+        """
+        self.queue.put((topic, payload, timestamp or utc_timestamp(), data))
+
+    def run(self):
+        # The connection must be created in the thread that uses it
+        conn = connect(self.db_path)
+        init_db(conn)
+        self._ready.set()
+        batch = []
+        deadline = None
+        next_prune = time.monotonic()
+        try:
+            while True:
+                if self.keep_days and time.monotonic() >= next_prune:
+                    self._prune(conn)
+                    next_prune = time.monotonic() + self.prune_interval
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    self._flush(conn, batch)
+                    batch = []
+                    deadline = None
+            # Drain whatever is still queued on shutdown
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+            if batch:
+                self._flush(conn, batch)
+        finally:
+            conn.close()
+
+    def _flush(self, conn, batch):
+        try:
+            with metrics.timer('sqlite_commit'):
+                insert_messages(conn, batch)
+            self.rows_written += len(batch)
+            metrics.count('rows_written', len(batch))
+        except Exception as e:
+            # The transaction was rolled back: retry row by row so one bad message only loses itself
+            metrics.count('sqlite_error')
+            print(f"Error al guardar {len(batch)} mensajes en la base de datos: {e}, reintentando uno a uno")
+            for row in batch:
+                self._write_row(conn, row)
+
+    def _write_row(self, conn, row):
+        try:
+            insert_messages(conn, [row])
+        except Exception as e:
+            metrics.count('sqlite_bad_row')
+            print(f"Mensaje de {row[0]} descartado, no se pudo guardar: {e}")
+            return
+        self.rows_written += 1
+        metrics.count('rows_written')
+
+    def _prune(self, conn):
+        try:
+            deleted = prune(conn, self.keep_days)
+            if deleted:
+                print(f"Retencion: {deleted} mensajes de mas de {self.keep_days} dias eliminados")
+        except sqlite3.Error as e:
+            print(f"Error al aplicar la retencion: {e}")
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def stop(self, timeout=None):
+        """Flush pending messages and close the connection."""
+        self.queue.put(None)
+        self.join(timeout)
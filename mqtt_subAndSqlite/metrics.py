@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lightweight stage timing for the ISUM processes, exported in the Prometheus
+text format.
+
+    with metrics.timer('stats'):
+        ...
+    metrics.count('mqtt_dropped')
+
+Durations go to one histogram, isum_stage_seconds{stage=...}, and events to
+isum_events_total{event=...}. Instrumentation is off unless the ISUM_METRICS
+environment variable is set (or enable() is called). When it is off, timer()
+returns a shared no-op context manager and count()/observe() return at once,
+so the hot paths pay one function call.
+
+start_exporter() publishes the metrics of the process:
+- ISUM_METRICS_FILE=path rewrites that file every ISUM_METRICS_INTERVAL
+  seconds (node_exporter textfile collector);
+- otherwise an HTTP endpoint serves /metrics on ISUM_METRICS_PORT (or the
+  default port of the process).
+
+This file is shared verbatim by IsumAndrasperry/, mqtt_clientAndUART/ and
+mqtt_subAndSqlite/; check_shared_modules.py verifies the copies.
+"""
+
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENABLED = os.environ.get('ISUM_METRICS', '') not in ('', '0')
+
+# Upper bounds (s) of the histogram buckets, from sub-millisecond socket sends to capture runs
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_histograms = {}  # stage -> [bucket counts (last one is +Inf), sum, count]
+_events = {}      # event -> total
+_pending = None   # (observe or count, name, value) not yet drained, only in worker processes (see collect)
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def observe(stage, seconds):
+    """Record one duration of a stage."""
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+        if _pending is not None:
+            _pending.append((observe, stage, seconds))
+
+def count(event, value=1):
+    """Add to an event counter (dropped messages, checksum errors...)."""
+    if not ENABLED:
+        return
+    with _lock:
+        _events[event] = _events.get(event, 0) + value
+        if _pending is not None:
+            _pending.append((count, event, value))
+
+class _Timer:
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def timer(stage):
+    """Context manager timing its block as one observation of `stage`."""
+    return _Timer(stage) if ENABLED else _NULL_TIMER
+
+def collect():
+    """Keep the observations of this (worker) process so drain() can hand them to the parent."""
+    global _pending
+    _pending = []
+
+def drain():
+    """Observations made since the last drain; empty unless collect() was called."""
+    global _pending
+    with _lock:
+        if not _pending:
+            return []
+        observations, _pending = _pending, []
+    return observations
+
+def merge(observations):
+    """Record the observations and counts drained in a worker process."""
+    for record, name, value in observations:
+        record(name, value)
+
+def _format(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in _histograms.items()}
+        events = dict(_events)
+    lines = ['# HELP isum_stage_seconds Duration of the instrumented pipeline stages.',
+             '# TYPE isum_stage_seconds histogram']
+    for stage, (counts, total, n) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + (float('inf'),), counts):
+            cumulative += bucket
+            lines.append(f'isum_stage_seconds_bucket{{stage="{stage}",le="{_format(bound)}"}} {cumulative}')
+        lines.append(f'isum_stage_seconds_sum{{stage="{stage}"}} {total!r}')
+        lines.append(f'isum_stage_seconds_count{{stage="{stage}"}} {n}')
+    lines += ['# HELP isum_events_total Counted pipeline events.', '# TYPE isum_events_total counter']
+    for event, total in sorted(events.items()):
+        lines.append(f'isum_events_total{{event="{event}"}} {total}')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the console
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve /metrics from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+def write_file(path):
+    """Rewrite the metrics file atomically (temporary file + rename)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+def start_file_exporter(path, interval=15.0):
+    """Rewrite `path` every `interval` seconds from a daemon thread."""
+    def run():
+        while True:
+            try:
+                write_file(path)
+            except OSError as e:
+                print(f"No se pudieron escribir las metricas en {path}: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='metrics-file', daemon=True)
+    thread.start()
+    return thread
+
+def start_exporter(default_port):
+    """Start the exporter configured by the environment; does nothing if metrics are disabled."""
+    if not ENABLED:
+        return None
+    path = os.environ.get('ISUM_METRICS_FILE')
+    if path:
+        print(f"Metricas en {path}")
+        return start_file_exporter(path, float(os.environ.get('ISUM_METRICS_INTERVAL', 15)))
+    port = int(os.environ.get('ISUM_METRICS_PORT', default_port))
+    try:
+        server = start_http_server(port)
+    except OSError as e:
+        print(f"No se pudo abrir el puerto de metricas {port}: {e}")
+        return None
+    print(f"Metricas en http://0.0.0.0:{port}/metrics")
+    return server
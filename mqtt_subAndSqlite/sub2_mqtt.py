@@ -2,91 +2,130 @@
 # -*- coding: utf-8 -*-
 
 
+import argparse
 import paho.mqtt.client as mqtt
-import sqlite3
 import json
+from isum_db import BatchWriter, DB_PATH, utc_timestamp
+from ingest import IngestPool, POLICIES
+from telemetry_codec import TelemetryDecoder, CodecError, decode_message
+import metrics
 
 # Configuracin del broker MQTT
 BROKER = "192.168.1.71" 
 PORT = 1883  
-TOPIC = "test/topic"  
+# Un subtopico por dispositivo o pasarela. "test/topic/#" ya incluye "test/topic": un segundo
+# filtro que se solape haria que el broker entregue (y se guarde) cada mensaje dos veces
+TOPICS = ["test/topic/#"]
+QOS = 1
 USERNAME = "lywsz"  
 PASSWORD = "992258"  
 
-# Conexion a la base de datos SQLite
-def init_db():
-    conn = sqlite3.connect('Isum.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            topic TEXT NOT NULL,
-            payload TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-#  SQLite
-def save_to_db(topic, payload):
-    conn = sqlite3.connect('Isum.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO messages (topic, payload) VALUES (?, ?)', (topic, payload))
-    conn.commit()
-    conn.close()
+# /metrics endpoint cuando ISUM_METRICS esta definida
+METRICS_PORT = 9103
+
+# Escritor SQLite con una sola conexion; agrupa los mensajes en lotes
+writer = BatchWriter(DB_PATH)
+
+# Imprimir cada mensaje recibido (--verbose); desactivado por defecto
+VERBOSE = False
+
+def handle_message(topic, raw, received, state):
+    """Decode, validate and queue one message for SQLite (runs in an ingest worker)."""
+    # Decodificadores del formato binario, uno por topico (los deltas son por topico)
+    decoder = state.setdefault(topic, TelemetryDecoder())
+    try:
+        # Acepta el formato binario compacto y el JSON anterior
+        with metrics.timer('mqtt_decode'):
+            json_data, encoding = decode_message(raw, decoder)
+        if encoding == 'binary' and decoder.duplicate:
+            # Reentrega QoS 1 del mensaje anterior: ya esta guardado
+            metrics.count('duplicate_message')
+            return
+        payload = json.dumps(json_data) if encoding == 'binary' else raw.decode('utf-8')
+        if encoding == 'binary' and decoder.partial:
+            # Se perdio un mensaje anterior: se guarda lo que no depende de el
+            metrics.count('decode_partial')
+            print(f"Aviso: mensaje binario de {topic} incompleto (falta la referencia de sus deltas)")
+    except CodecError as e:
+        metrics.count('decode_error')
+        print(f"Error: mensaje binario de {topic} descartado: {e}")
+        return
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        metrics.count('decode_error')
+        print(f"Error: El mensaje recibido en {topic} no es un JSON valido.")
+        return
+    if VERBOSE:
+        print(f"Mensaje recibido en el topico {topic} ({encoding}, {len(raw)} bytes): {payload}")
+
+    writer.submit(topic, payload, timestamp=utc_timestamp(received), data=json_data)
 
 #  broker
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Conectado al broker con exito")
         # Suscribirse
-        client.subscribe(TOPIC)
-        print(f"Suscrito al topico: {TOPIC}")
+        client.subscribe([(topic, QOS) for topic in TOPICS])
+        print(f"Suscrito a los topicos: {', '.join(TOPICS)}")
     else:
         print(f"Error al conectarse, codigo de error: {rc}")
 
-#recibe un mensaje del broker
+#recibe un mensaje del broker: solo se encola, el resto lo hacen los workers
 def on_message(client, userdata, msg):
+    userdata.submit(msg.topic, msg.payload)
+
+def main():
+    global VERBOSE
+    parser = argparse.ArgumentParser(description='ISUM MQTT subscriber: stores the telemetry in SQLite.')
+    parser.add_argument('--workers', type=int, default=4, help='Ingest worker threads')
+    parser.add_argument('--queue-size', type=int, default=10000, help='Messages queued in memory')
+    parser.add_argument('--policy', choices=POLICIES, default='spill',
+                        help='What to do when the queue is full: block, drop (oldest) or spill to disk')
+    parser.add_argument('--spill-dir', default='spill')
+    parser.add_argument('--verbose', action='store_true', help='Print every received message')
+    args = parser.parse_args()
+    VERBOSE = args.verbose
+
+    pool = IngestPool(handle_message, args.workers, args.queue_size, args.policy, args.spill_dir)
+
+    # Crear una instancia del cliente MQTT
+    client = mqtt.Client(userdata=pool)
+
+    # Configurar credenciales de autenticacin
+    client.username_pw_set(USERNAME, PASSWORD)
+
+    # Asignar funciones de callback
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    # Inicializar la base de datos y arrancar el escritor y los workers
+    writer.start()
+    writer.wait_ready()
+    pool.start()
+    metrics.start_exporter(METRICS_PORT)
+
+    # Conectar al broker
     try:
-        payload = msg.payload.decode('utf-8')
-        print(f"Mensaje recibido en el topico {msg.topic}: {payload}")
-        
-        # Validar si el mensaje es JSON valido
-        json_data = json.loads(payload)
-        print("Datos JSON validos recibidos:", json_data)
-        
-        # Guardar en SQLite
-        save_to_db(msg.topic, payload)
-        print("Datos guardados en la base de datos.")
-    except json.JSONDecodeError:
-        print("Error: El mensaje recibido no es un JSON valido.")
-
-# Crear una instancia del cliente MQTT
-client = mqtt.Client()
-
-# Configurar credenciales de autenticacin
-client.username_pw_set(USERNAME, PASSWORD)
-
-# Asignar funciones de callback
-client.on_connect = on_connect
-client.on_message = on_message
-
-# Inicializar la base de datos
-init_db()
-
-# Conectar al broker
-try:
-    client.connect(BROKER, PORT, keepalive=60)
-except Exception as e:
-    print(f"No se pudo conectar al broker: {e}")
-    exit(1)
-
-# Mantener el cliente ejecutndose para escuchar los mensajes
-try:
-    print("Esperando mensajes... Presiona Ctrl+C para salir.")
-    client.loop_forever()
-except KeyboardInterrupt:
-    print("Desconectandose del broker...")
-    client.disconnect()
-    print("Cliente desconectado.")
+        client.connect(BROKER, PORT, keepalive=60)
+    except Exception as e:
+        print(f"No se pudo conectar al broker: {e}")
+        pool.stop()
+        writer.stop()
+        exit(1)
+
+    # Mantener el cliente ejecutndose para escuchar los mensajes
+    try:
+        print("Esperando mensajes... Presiona Ctrl+C para salir.")
+        client.loop_forever()
+    except KeyboardInterrupt:
+        print("Desconectandose del broker...")
+        client.disconnect()
+        print("Cliente desconectado.")
+    finally:
+        # Procesar y guardar los mensajes pendientes antes de salir
+        pool.stop()
+        writer.stop()
+        print(f"Ingesta: {pool.stats()}")
+        print(f"Mensajes guardados en la base de datos: {writer.rows_written}")
+
+if __name__ == '__main__':
+    main()